@@ -0,0 +1,198 @@
+import argparse
+import json
+import platform
+import random
+import time
+import tracemalloc
+
+import can
+from canparse import nmea2000, fragmenter
+
+#deterministic NMEA 2000 traffic and decoder benchmarks, results are written as JSON
+#frames_per_s is the best of --repeat untraced runs, one more run under tracemalloc counts the
+#memory blocks (and bytes) allocated during the run that are still alive when all results are kept,
+#per frame; inputs are built before tracing starts so freeing them does not cancel anything out
+
+def decoderpgns():
+    #every pgn with a decsp*/decfp* method, True for fast packets (transport protocol frames count as single)
+    n = nmea2000(None)
+    names = {int(name[5:]) for name in dir(n) if name[:5] in ("decsp", "decfp") and name[5:].isdigit()}
+    return {pgn: n.decoders[pgn][0] == 1 for pgn in sorted(names) if pgn in n.decoders}
+
+def payload(rng, pgn, fast):
+    #a payload the decoder of pgn can parse
+    if pgn == 126996: #Product Information
+        return bytes(rng.getrandbits(8) for _ in range(4)) + b"".join(
+            rng.choice((b"model", b"1.0.2", b"rev A", b"SN12345")).ljust(32, b"\xff") for _ in range(4)) + bytes((1, 2))
+    if pgn == 126998: #Configuration Information
+        return b"".join(bytes((len(s)+2, 1)) + s for s in (b"mast", b"port side", b"canparse"))
+    if pgn == 129540: #GNSS Sats in View
+        sats = rng.randint(1, 12)
+        return bytes((rng.getrandbits(8), 0, sats)) + bytes(rng.getrandbits(8) for _ in range(12*sats))
+    if fast:
+        return bytes(rng.getrandbits(8) for _ in range({127506: 11, 127513: 8}.get(pgn, 32)))
+    return bytes(rng.getrandbits(8) for _ in range(8))
+
+def traffic(count, seed=1, sources=8, interleave=4):
+    #count frames covering all decoder pgns, fast packets from up to interleave sessions
+    #are mixed frame by frame, session counters advance per (source, pgn)
+    rng = random.Random(seed)
+    pgns = list(decoderpgns().items())
+    fragments = fragmenter()
+    sessions = []
+    frames = []
+    ts = 0.
+    while len(frames) < count:
+        if sessions and (len(sessions) >= interleave or rng.random() < 0.5):
+            session = rng.choice(sessions)
+            arb, parts = session
+            frames.append(can.Message(timestamp=ts, arbitration_id=arb, data=parts.pop(0)))
+            if not parts:
+                sessions.remove(session)
+        else:
+            pgn, fast = rng.choice(pgns)
+            source = rng.randint(1, sources)
+            arb = (2 << 26) | (pgn << 8) | source
+            data = payload(rng, pgn, fast)
+            if fast:
+                sessions.append((arb, fragments.frames(source, pgn, data)))
+                continue
+            frames.append(can.Message(timestamp=ts, arbitration_id=arb, data=data))
+        ts += 0.0005
+    return frames
+
+def allocations(func, frames):
+    #blocks and bytes allocated by func() and kept alive by its results, and the peak, per frame
+    tracemalloc.start()
+    try:
+        kept = func()
+        current, peak = tracemalloc.get_traced_memory()
+        blocks = len(tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)]).traces)
+    finally:
+        tracemalloc.stop()
+    del kept
+    if not frames:
+        return {"blocks_per_frame": None, "bytes_per_frame": None, "peak_bytes_per_frame": None}
+    return {"blocks_per_frame": blocks / frames, "bytes_per_frame": current / frames, "peak_bytes_per_frame": peak / frames}
+
+def measure(name, func, frames, repeat):
+    #func() processes frames frames and returns its results
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return {"name": name, "frames": frames, "seconds": best,
+            "frames_per_s": frames / best if best else None, **allocations(func, frames)}
+
+def benchdecodepgn(msgs, repeat):
+    n = nmea2000(None)
+    ids = [m.arbitration_id for m in msgs]
+    return measure("decodepgn", lambda: [n.decodepgn(arb) for arb in ids], len(ids), repeat)
+
+def benchfastpacket(msgs, repeat):
+    fast = {pgn for pgn, f in decoderpgns().items() if f}
+    frames = [((m.arbitration_id >> 8) & 0x3ffff, m.data, m.arbitration_id & 0xff, m.timestamp)
+              for m in msgs if (m.arbitration_id >> 8) & 0x3ffff in fast]
+    def run():
+        n = nmea2000(None)
+        return [n.pushfastpacket(pgn, data, source, ts) for pgn, data, source, ts in frames]
+    return measure("pushfastpacket", run, len(frames), repeat)
+
+def benchdecoders(seed, count, repeat):
+    rng = random.Random(seed)
+    n = nmea2000(None)
+    results = []
+    for pgn, fast in decoderpgns().items():
+        decoder = n.decoders[pgn][1]
+        payloads = [bytearray(payload(rng, pgn, fast)) for _ in range(count)]
+        results.append(measure(f"decoder {pgn}", lambda: [n.decodeone(decoder, d) for d in payloads], count, repeat))
+    return results
+
+def benchencode(msgs, repeat):
+    #encodeframes for every decoded pgn of the traffic that has an encoder
+    n = nmea2000(None)
+    records = []
+    for m in msgs:
+        if (ret := n.decodemessage(m)) is not None and isinstance(ret[1], dict) and "parseerror" not in ret[1]:
+            try:
+                n.encoder(ret[0])
+            except KeyError:
+                continue
+            records.append((ret[0], ret[1], m.arbitration_id & 0xff))
+    tx = nmea2000(None)
+    return measure("encodeframes", lambda: [tx.encodeframes(pgn, values, source) for pgn, values, source in records], len(records), repeat)
+
+def benchcache(msgs, seed, repeat):
+    #decodemessage with the decode cache, after checking that every hit is a copy of its own:
+    #changing a result in place must not show up in the next hit for the same payload
+    rng = random.Random(seed)
+    plain = nmea2000(None)
+    n = nmea2000(None)
+    n.cache()
+    fast = decoderpgns()
+    for pgn in n.decodecache.sizes:
+        if pgn not in n.decoders:
+            continue
+        data = payload(rng, pgn, fast.get(pgn, False))
+        expected = plain.decodeone(plain.decoders[pgn][1], bytearray(data))
+        for _ in range(2): #miss, then hits
+            ret = n.decodeone(n.decoders[pgn][1], bytearray(data))
+            if ret != expected:
+                raise AssertionError(f"cached decode of {pgn} changed by an earlier caller")
+            for key, value in ret.items():
+                if isinstance(value, (bytearray, list, dict)):
+                    value.clear()
+                ret[key] = None
+    return measure("decodemessage cached", lambda: [n.decodemessage(m) for m in msgs], len(msgs), repeat)
+
+def benchreceivenext(msgs, repeat):
+    #whole receive path against a python-can virtual bus, the frames are queued before timing
+    #and before tracing, the queued copies freed by recv() are not counted
+    rx = can.Bus(interface="virtual", channel="canparse-benchmark")
+    tx = can.Bus(interface="virtual", channel="canparse-benchmark")
+    try:
+        best = None
+        for _ in range(repeat):
+            n = nmea2000(rx)
+            for m in msgs:
+                tx.send(m)
+            start = time.perf_counter()
+            kept = [n.receivenext() for _ in msgs]
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+            del kept
+        n = nmea2000(rx)
+        for m in msgs:
+            tx.send(m)
+        return {"name": "receivenext", "frames": len(msgs), "seconds": best, "frames_per_s": len(msgs) / best,
+                **allocations(lambda: [n.receivenext() for _ in msgs], len(msgs))}
+    finally:
+        rx.shutdown()
+        tx.shutdown()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="canparse decode benchmarks")
+    parser.add_argument("--frames", type=int, default=20000, help="frames of generated traffic")
+    parser.add_argument("--decoder-frames", type=int, default=2000, help="payloads per decoder")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="JSON file, default stdout")
+    args = parser.parse_args(argv)
+
+    msgs = traffic(args.frames, args.seed)
+    results = [benchdecodepgn(msgs, args.repeat), benchfastpacket(msgs, args.repeat),
+               *benchdecoders(args.seed, args.decoder_frames, args.repeat), benchencode(msgs, args.repeat),
+               benchcache(msgs, args.seed, args.repeat), benchreceivenext(msgs, args.repeat)]
+    report = {"python": platform.python_version(), "implementation": platform.python_implementation(),
+              "machine": platform.machine(), "can": can.__version__, "seed": args.seed, "results": results}
+    text = json.dumps(report, indent=1)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
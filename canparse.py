@@ -1,49 +1,1512 @@
 import can
-from math import ceil
-from struct import unpack
+import asyncio
+import threading
+from collections import deque
+from copy import deepcopy
+from mmap import mmap, ACCESS_READ
+from time import monotonic, sleep, perf_counter, strftime
+from bisect import bisect_left
+from struct import unpack, Struct
+from array import array
+from heapq import merge
+from queue import Empty
+
+class fastpacket:
+    #fast packet reassembly, sessions keyed by (source, pgn, session counter)
+    def __init__(self, maxsessions=64, timeout=1.0):
+        self.maxsessions = maxsessions
+        self.timeout = timeout
+        self.sessions = {} #key -> [started, datalen, fullmask, mask, buffer], oldest first
+        self.completed = 0
+        self.dropped = 0 #evicted because the table was full
+        self.overwritten = 0 #restarted before completion
+        self.timedout = 0
+        self.orphans = 0 #frames without a started session
+
+    def push(self, source, pgn, msg, now=None):
+        if now is None:
+            now = monotonic()
+        sc = msg[0] >> 5 #session counter
+        fc = msg[0] & 0x1f #frame counter
+        key = (source, pgn, sc)
+        sessions = self.sessions
 
-class nmea2000:
-    buffer = {}
-    bus = None
+        if fc == 0:
+            datalen = msg[1]
+            if datalen <= 6:
+                self.completed += 1
+                return bytearray(msg[2:2+datalen])
+            if sessions.pop(key, None) is not None:
+                self.overwritten += 1
+            self.expire(now)
+            while len(sessions) >= self.maxsessions:
+                del sessions[next(iter(sessions))]
+                self.dropped += 1
+            frames = (datalen + 7) // 7 #6 bytes in frame 0, 7 in every following one
+            buf = bytearray(7*frames - 1)
+            buf[0:len(msg)-2] = msg[2:8]
+            sessions[key] = [now, datalen, (1 << frames) - 1, 1, buf]
+            return None
+
+        if (session := sessions.get(key)) is None:
+            self.orphans += 1
+            return None
+        if now - session[0] > self.timeout:
+            del sessions[key]
+            self.timedout += 1
+            self.orphans += 1
+            return None
+        bit = 1 << fc
+        if bit > session[2]:
+            return None
+        pnt = 7*fc - 1
+        session[4][pnt:pnt+len(msg)-1] = msg[1:8]
+        session[3] |= bit
+        if session[3] == session[2]:
+            del sessions[key]
+            self.completed += 1
+            return session[4][:session[1]]
+        return None
 
-    def __init__(self, canbus):
-        self.bus=canbus
+    def expire(self, now=None):
+        #sessions are kept in start order, so only the oldest ones need checking
+        if now is None:
+            now = monotonic()
+        sessions = self.sessions
+        while sessions:
+            key = next(iter(sessions))
+            if now - sessions[key][0] <= self.timeout:
+                break
+            del sessions[key]
+            self.timedout += 1
+
+    def stats(self):
+        return {"sessions": len(self.sessions), "completed": self.completed, "dropped": self.dropped,
+                "overwritten": self.overwritten, "timedout": self.timedout, "orphans": self.orphans}
+
+class fragmenter:
+    #splits payloads into fast packet frames as fastpacket.push expects them, the session counter
+    #advances per (source, pgn) so receivers can tell consecutive packets apart
+    maxlength = 223 #6 bytes in frame 0 and 7 in each of the 31 following
+
+    def __init__(self):
+        self.counters = {}
+
+    def frames(self, source, pgn, data):
+        #list of 8 byte frames, the last one padded with 0xff
+        if len(data) > self.maxlength:
+            raise ValueError(f"{len(data)} bytes do not fit a fast packet")
+        key = (source, pgn)
+        sc = self.counters[key] = (self.counters.get(key, -1) + 1) & 7
+        n = (len(data) + 7) // 7
+        buf = bytearray(b"\xff" * 8*n)
+        buf[0], buf[1] = sc << 5, len(data)
+        buf[2:2+min(6, len(data))] = data[:6]
+        for fc, pos in enumerate(range(6, len(data), 7), 1):
+            buf[8*fc] = sc << 5 | fc
+            buf[8*fc+1:8*fc+1+len(data[pos:pos+7])] = data[pos:pos+7]
+        return [buf[i:i+8] for i in range(0, len(buf), 8)]
+
+class replaybus:
+    #bus-like source streaming a capture file through the decoder, recv() returns None at the end
+    #.bin files use the fixed record format below and are read through mmap, everything else
+    #(candump .log, Vector .asc/.blf, ...) goes through can.LogReader
+    #speed None replays as fast as possible, otherwise timestamps are followed scaled by speed
+    record = Struct("<dIB3x8s") #timestamp, arbitration id, dlc, data
+
+    def __init__(self, filename, speed=None, binary=None):
+        self.filename = filename
+        self.speed = speed
+        self.binary = str(filename).endswith(".bin") if binary is None else binary
+        self.messages = iter(self)
+
+    def __iter__(self):
+        start = None
+        for msg in (self.readbinary() if self.binary else can.LogReader(self.filename)):
+            if self.speed:
+                if start is None:
+                    start = (msg.timestamp, monotonic())
+                elif (delay := (msg.timestamp - start[0]) / self.speed - (monotonic() - start[1])) > 0:
+                    sleep(delay)
+            yield msg
+
+    def readbinary(self):
+        size = self.record.size
+        with open(self.filename, "rb") as f:
+            if (length := f.seek(0, 2)) < size:
+                return
+            with mmap(f.fileno(), 0, access=ACCESS_READ) as mm:
+                for offset in range(0, length - length % size, size):
+                    ts, arb, dlc, data = self.record.unpack_from(mm, offset)
+                    yield can.Message(timestamp=ts, arbitration_id=arb, is_extended_id=True, dlc=dlc, data=data[:dlc])
+
+    @classmethod
+    def writebinary(cls, filename, messages):
+        #convert any message iterable (e.g. can.LogReader) to the .bin record format
+        n = 0
+        with open(filename, "wb") as f:
+            for msg in messages:
+                f.write(cls.record.pack(msg.timestamp, msg.arbitration_id, msg.dlc, bytes(msg.data)))
+                n += 1
+        return n
+
+    def recv(self, timeout=None):
+        return next(self.messages, None)
+
+    def shutdown(self):
+        pass
+
+class asyncreceiver(can.Listener):
+    #async with asyncreceiver(decoder) as frames: async for pgn, data in frames, frames come in through a can.Notifier
+    #that runs until close(), leaving the async with (or ending an async for over the decoder) closes it
+    #the queue holds at most maxsize frames, policy decides what happens when it is full:
+    #"oldest"/"newest" drop a frame and count it, "block" stops reading the bus until there is room
+    #several buses in one loop: one nmea2000 and one asyncreceiver per bus
+    def __init__(self, decoder, maxsize=1024, policy="oldest"):
+        if policy not in ("oldest", "newest", "block"):
+            raise ValueError(f"unknown policy {policy}")
+        self.decoder = decoder
+        self.maxsize = maxsize
+        self.policy = policy
+        self.queue = deque()
+        self.slots = threading.Semaphore(maxsize) if policy == "block" else None
+        self.dropped = 0
+        self.error = None
+        self.loop = None
+        self.ready = None
+        self.notifier = None
+
+    def start(self):
+        if self.notifier is None:
+            self.loop = asyncio.get_running_loop()
+            self.ready = asyncio.Event()
+            #blocking needs the notifier thread, a reader inside the loop would deadlock it
+            self.notifier = can.Notifier(self.decoder.bus, [self], loop=None if self.slots else self.loop)
+        return self
+
+    def close(self):
+        if (notifier := self.notifier) is not None:
+            self.notifier = None
+            if self.slots is not None:
+                self.slots.release() #wake a blocked notifier thread
+            notifier.stop()
+            self.ready.set()
+
+    def on_message_received(self, msg):
+        if self.notifier is None:
+            return
+        if self.slots is not None:
+            self.slots.acquire()
+        try:
+            self.loop.call_soon_threadsafe(self.put, msg)
+        except RuntimeError: #loop closed
+            pass
+
+    def on_error(self, exc):
+        self.error = exc
+        self.loop.call_soon_threadsafe(self.ready.set)
+
+    def put(self, msg):
+        if self.slots is None and len(self.queue) >= self.maxsize:
+            self.dropped += 1
+            if self.policy == "newest":
+                return
+            self.queue.popleft()
+        self.queue.append(msg)
+        self.ready.set()
+
+    def __aiter__(self):
+        return self.start()
+
+    async def __anext__(self):
+        queue = self.queue
+        while True:
+            while not queue:
+                if self.error is not None:
+                    raise self.error
+                if self.notifier is None:
+                    raise StopAsyncIteration
+                self.ready.clear()
+                await self.ready.wait()
+            msg = queue.popleft()
+            if self.slots is not None:
+                self.slots.release()
+            if (ret := self.decoder.decodemessage(msg)) is not None:
+                return ret
+
+    async def __aenter__(self):
+        return self.start()
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+class framering:
+    #single producer, single consumer ring of frames in one preallocated bytearray, records as in .bin captures
+    #put copies a frame in without creating objects, a full ring drops the new frame and counts it in overflows
+    record = replaybus.record #timestamp, arbitration id, dlc, data
+
+    def __init__(self, capacity=8192):
+        self.capacity = capacity
+        self.buffer = bytearray(capacity * self.record.size)
+        self.head = 0 #frames written, only changed by the producer
+        self.tail = 0 #frames read, only changed by the consumer
+        self.overflows = 0
+        self.highwater = 0 #most frames the ring held at once
+        self.ready = threading.Event() #set when a frame goes into a ring the consumer had emptied
+
+    def put(self, timestamp, arbitration_id, dlc, data):
+        head = self.head
+        if (fill := head - self.tail) >= self.capacity:
+            self.overflows += 1
+            return False
+        self.record.pack_into(self.buffer, head % self.capacity * self.record.size, timestamp, arbitration_id, dlc, data)
+        self.head = head + 1
+        if fill >= self.highwater:
+            self.highwater = fill + 1
+        #tail read again after publishing head: the consumer may have drained since fill was taken
+        #and be waiting already, a fill from before the write would miss that wakeup
+        if self.tail == head:
+            self.ready.set()
+        return True
+
+    def wait(self, timeout=None):
+        #True as soon as the ring holds a frame, False after timeout
+        while self.head == self.tail:
+            self.ready.clear()
+            if self.head != self.tail:
+                break
+            if not self.ready.wait(timeout):
+                return False
+        return True
+
+    def drain(self, maxframes=None, timeout=0):
+        #up to maxframes (timestamp, arbitration id, dlc, data) in arrival order, waits up to timeout for the first
+        if self.head == self.tail and (timeout == 0 or not self.wait(timeout)):
+            return []
+        tail, size = self.tail, self.record.size
+        n = self.head - tail if maxframes is None else min(self.head - tail, maxframes)
+        start = tail % self.capacity
+        first = min(n, self.capacity - start)
+        view = memoryview(self.buffer)
+        frames = list(self.record.iter_unpack(view[start*size:(start+first)*size]))
+        if n > first:
+            frames += self.record.iter_unpack(view[:(n-first)*size])
+        self.tail = tail + n
+        return frames
+
+    def stats(self):
+        return {"capacity": self.capacity, "fill": self.head - self.tail, "highwater": self.highwater,
+                "overflows": self.overflows, "frames": self.head}
+
+class ringreceiver:
+    #receive thread that only copies frames from decoder.bus into a framering, decoding happens in the
+    #consumer (receivebatch or iteration) so a slow decoder or consumer does not stop the bus from being drained
+    def __init__(self, decoder, capacity=8192, batchsize=512):
+        self.decoder = decoder
+        self.ring = framering(capacity)
+        self.batchsize = batchsize
+        self.thread = None
+        self.running = False
+        self.error = None
+
+    def start(self):
+        if self.thread is None:
+            self.running = True
+            self.thread = threading.Thread(target=self.run, name="canparse receiver", daemon=True)
+            self.thread.start()
+        return self
+
+    def run(self):
+        recv, put = self.decoder.bus.recv, self.ring.put
+        try:
+            while self.running:
+                if (msg := recv(0.1)) is not None:
+                    put(msg.timestamp, msg.arbitration_id, msg.dlc, msg.data)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.running = False
+            self.ring.ready.set()
+
+    def close(self):
+        self.running = False
+        if (thread := self.thread) is not None:
+            self.thread = None
+            thread.join()
+
+    def receivebatch(self, timeout=None):
+        #decoded (pgn, data) of up to batchsize frames, waits up to timeout for the first frame
+        frames = self.ring.drain(self.batchsize, timeout)
+        if not frames and self.error is not None:
+            raise self.error
+        decodeframe = self.decoder.decodeframe
+        return [ret for ts, arb, dlc, data in frames if (ret := decodeframe(arb, data[:dlc], ts)) is not None]
+
+    def __iter__(self):
+        self.start()
+        ring = self.ring
+        while self.running or ring.head != ring.tail:
+            yield from self.receivebatch(0.1)
+        if self.error is not None:
+            raise self.error
+
+    def stats(self):
+        return self.ring.stats()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+def istransport(arb):
+    #TP.CM or TP.DT frame, the pgn it carries is only known after reassembly
+    return (arb & 0x3ffffff) >> 16 in (0xEB, 0xEC)
+
+def streamkey(arb):
+    #shard key of a frame, transport protocol sessions span TP.CM and TP.DT ids and both directions
+    arb &= 0x3ffffff
+    return 0xEB00 if istransport(arb) else arb
+
+def packresults(indices, pgns, out):
+    #decoded data of one shard for the trip back: indices and pgns as arrays, dicts as value tuples
+    #with their key tuple sent once, about half the pickle of (index, pgn, dict) and far cheaper to load
+    layouts, ids = {}, array("H")
+    values = []
+    for data in out:
+        if type(data) is dict:
+            ids.append(layouts.setdefault(tuple(data), len(layouts)))
+            values.append(tuple(data.values()))
+        else:
+            ids.append(0xffff)
+            values.append(data)
+    return indices.tobytes(), pgns.tobytes(), list(layouts), ids.tobytes(), values
+
+def unpackresults(packed):
+    #(index, pgn, data) in index order
+    indices, pgns, layouts, ids, values = packed
+    for index, pgn, layout, value in zip(array("I", indices), array("I", pgns), array("H", ids), values):
+        yield index, pgn, value if layout == 0xffff else dict(zip(layouts[layout], value))
+
+def shardworker(tasks, results, recordformat, maxsessions, timeout):
+    #worker process of shardeddecoder, keeps one decoder per bus
+    from multiprocessing.shared_memory import SharedMemory
+    decoders = {}
+    record = Struct(recordformat)
+    size = record.size
+    while (task := tasks.get()) is not None:
+        batch, name, offset, count = task
+        indices, pgns, out = array("I"), array("I"), []
+        if isinstance(name, tuple): #("file", filename): .bin capture, offset holds this worker's record indices
+            decoder = decoders.get(-1) or decoders.setdefault(-1, nmea2000(None, fastpacket(maxsessions, timeout)))
+            fileio = replaybus.record
+            fsize = fileio.size
+            with open(name[1], "rb") as f, mmap(f.fileno(), 0, access=ACCESS_READ) as mm:
+                for index in array("I", offset):
+                    ts, arb, dlc, data = fileio.unpack_from(mm, index*fsize)
+                    if (ret := decoder.decodeframe(arb, data[:dlc], ts)) is not None:
+                        indices.append(index)
+                        pgns.append(ret[0])
+                        out.append(ret[1])
+            results.put((batch, packresults(indices, pgns, out)))
+            continue
+        shm = SharedMemory(name=name)
+        try:
+            buf = shm.buf
+            for pos in range(offset*size, (offset+count)*size, size):
+                index, ts, arb, dlc, channel, data = record.unpack_from(buf, pos)
+                if (decoder := decoders.get(channel)) is None:
+                    decoder = decoders[channel] = nmea2000(None, fastpacket(maxsessions, timeout))
+                if (ret := decoder.decodeframe(arb, data[:dlc], ts)) is not None:
+                    indices.append(index)
+                    pgns.append(ret[0])
+                    out.append(ret[1])
+            del buf
+        finally:
+            shm.close()
+        results.put((batch, packresults(indices, pgns, out))) #one pickle per batch and shard
+
+class shardeddecoder:
+    #decodes batches of frames in worker processes, results come back in input order
+    #shard "stream" hashes (source, pgn) so every fast packet stream stays in one worker
+    #(all transport protocol frames share one),
+    #shard "bus" keeps each channel (msg.channel) in one worker
+    #frames reach the workers through one shared memory block per batch, .bin captures
+    #are mapped by the workers directly (decodefile)
+    record = Struct("<IdIBB2x8s") #index in batch, timestamp, arbitration id, dlc, channel, data
+
+    def __init__(self, workers=None, batchsize=4096, shard="stream", inflight=2, maxsessions=64, timeout=1.0):
+        import multiprocessing
+        from multiprocessing import resource_tracker
+        if shard not in ("stream", "bus"):
+            raise ValueError(f"unknown shard {shard}")
+        self.nworkers = workers or multiprocessing.cpu_count()
+        self.batchsize = batchsize
+        self.shard = shard
+        self.inflight = inflight * self.nworkers
+        self.channels = {}
+        resource_tracker.ensure_running() #workers must share it, or each one reports the blocks as leaked
+        self.results = multiprocessing.Queue()
+        self.tasks = [multiprocessing.Queue() for _ in range(self.nworkers)]
+        self.workers = [multiprocessing.Process(target=shardworker, args=(q, self.results, self.record.format, maxsessions, timeout), daemon=True)
+                        for q in self.tasks]
+        for w in self.workers:
+            w.start()
+        self.pending = {} #batch -> [outstanding shards, results, shared memory]
+        self.nextbatch = 0
+        self.emitbatch = 0
+
+    def submit(self, messages):
+        #partition one batch by shard and hand it to the workers
+        from multiprocessing.shared_memory import SharedMemory
+        n = self.nworkers
+        shards = [[] for _ in range(n)]
+        for index, msg in enumerate(messages):
+            channel = self.channels.setdefault(msg.channel, len(self.channels) & 0xff)
+            key = channel if self.shard == "bus" else streamkey(msg.arbitration_id)
+            shards[key % n].append((index, msg, channel))
+        size = self.record.size
+        shm = SharedMemory(create=True, size=max(1, len(messages)*size))
+        buf = shm.buf
+        batch, offset, outstanding = self.nextbatch, 0, 0
+        for worker, frames in enumerate(shards):
+            if not frames:
+                continue
+            for pos, (index, msg, channel) in enumerate(frames, offset):
+                self.record.pack_into(buf, pos*size, index, msg.timestamp, msg.arbitration_id, msg.dlc, channel, bytes(msg.data))
+            self.tasks[worker].put((batch, shm.name, offset, len(frames)))
+            offset += len(frames)
+            outstanding += 1
+        del buf
+        self.pending[batch] = [outstanding, [], shm]
+        self.nextbatch += 1
+        if outstanding == 0:
+            self.release(batch)
+
+    def release(self, batch):
+        if (shm := self.pending[batch][2]) is not None:
+            shm.close()
+            shm.unlink()
+
+    def collect(self, timeout=None):
+        try:
+            batch, out = self.results.get(timeout=timeout)
+        except Empty:
+            return False
+        entry = self.pending[batch]
+        entry[0] -= 1
+        entry[1].append(out)
+        if entry[0] == 0:
+            self.release(batch)
+        return True
+
+    def ready(self):
+        #results of finished batches, in submission order
+        while (entry := self.pending.get(self.emitbatch)) is not None and entry[0] == 0:
+            del self.pending[self.emitbatch]
+            self.emitbatch += 1
+            #every shard comes back in index order
+            for index, pgn, data in merge(*map(unpackresults, entry[1]), key=lambda r: r[0]):
+                yield (pgn, data)
+
+    def decodemessages(self, messages):
+        #a None in messages (e.g. a recv timeout on a live bus) flushes the current batch
+        batch = []
+        for msg in messages:
+            if msg is not None:
+                batch.append(msg)
+                if len(batch) < self.batchsize:
+                    continue
+            if batch:
+                self.submit(batch)
+                batch = []
+            yield from self.ready()
+            while len(self.pending) > self.inflight:
+                self.collect()
+                yield from self.ready()
+        if batch:
+            self.submit(batch)
+        yield from self.ready()
+        while self.pending:
+            self.collect()
+            yield from self.ready()
+
+    def decodefile(self, filename):
+        #.bin captures (replaybus record format) are mapped by the workers themselves, the parent
+        #only reads the arbitration ids to hand every worker the record indices of its streams
+        size = replaybus.record.size
+        n = self.nworkers
+        chunk = self.batchsize * n
+        with open(filename, "rb") as f:
+            records = f.seek(0, 2) // size
+            mm = mmap(f.fileno(), 0, access=ACCESS_READ) if records else None
+        try:
+            for offset in range(0, records, chunk):
+                count = min(chunk, records - offset)
+                shards = [array("I") for _ in range(n)]
+                with memoryview(mm) as view:
+                    arbs = view[offset*size:(offset+count)*size].cast("I")[2::size//4] #record is <dIB3x8s
+                    for index, arb in enumerate(arbs, offset):
+                        shards[streamkey(arb) % n].append(index)
+                    arbs.release()
+                outstanding = 0
+                for q, indices in zip(self.tasks, shards):
+                    if indices:
+                        q.put((self.nextbatch, ("file", str(filename)), indices.tobytes(), len(indices)))
+                        outstanding += 1
+                self.pending[self.nextbatch] = [outstanding, [], None]
+                self.nextbatch += 1
+                while len(self.pending) > self.inflight:
+                    self.collect()
+                    yield from self.ready()
+        finally:
+            if mm is not None:
+                mm.close()
+        while self.pending:
+            self.collect()
+            yield from self.ready()
+
+    def close(self):
+        #a worker that has put results on self.results cannot exit before they are read, so when the
+        #consumer stopped early every outstanding shard is collected (and dropped) before the join
+        while any(entry[0] for entry in self.pending.values()):
+            if not self.collect(1.0) and not all(w.is_alive() for w in self.workers):
+                break
+        for q in self.tasks:
+            q.put(None)
+        for w in self.workers:
+            w.join()
+        for batch in list(self.pending):
+            if self.pending[batch][0]:
+                self.release(batch)
+        self.pending.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class message:
+    #lazily decoded payload, fields are computed when they are read
+    #reads like the decoder dicts (msg["voltage"], msg.get(...), keys()) and as_dict() builds the dict
+    __slots__ = ("payload", "raw")
+    fields = ()
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.raw = None
+
+    def __getitem__(self, key):
+        if key not in self.fields:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.fields else default
+
+    def __contains__(self, key):
+        return key in self.fields
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def keys(self):
+        return self.fields
+
+    def items(self):
+        return ((k, getattr(self, k)) for k in self.fields)
+
+    def as_dict(self):
+        return {k: getattr(self, k) for k in self.fields}
+
+    def __eq__(self, other):
+        return self.as_dict() == (other.as_dict() if isinstance(other, message) else other)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.as_dict()})"
+
+class fieldmessage(message):
+    #base of the classes generated by fieldspec.message, the unpacked tuple is kept in raw
+    __slots__ = ()
+    spec = None
+
+    def __init__(self, payload):
+        if len(payload) < self.spec.size:
+            raise IndexError("data too short")
+        self.payload = payload
+        self.raw = None
+
+    def unpack(self):
+        self.raw = self.spec.struct.unpack_from(self.payload)
+        return self.raw
+
+class lazytable:
+    #class attribute built on first access, keeps large tables out of the import
+    def __init__(self, build):
+        self.build = build
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, owner=None):
+        table = self.build()
+        setattr(owner, self.name, table)
+        return table
+
+class metrics:
+    #counters and decode latency histograms collected by nmea2000.instrument()
+    buckets = (1e-6, 2e-6, 5e-6, 1e-5, 2e-5, 5e-5, 1e-4, 2e-4, 5e-4, 1e-3, 1e-2) #seconds
+
+    def __init__(self, fastpackets=None, buckets=None, transports=None):
+        self.fastpackets = fastpackets
+        self.transports = transports
+        if buckets is not None:
+            self.buckets = tuple(buckets)
+        self.frames = {} #pgn -> frames
+        self.sources = {} #source -> frames
+        self.nodecoder = 0
+        self.parseerrors = {} #pgn -> IndexError fallbacks to retparseerror
+        self.latency = {} #pgn -> [count per bucket..., over the last bucket, sum]
+
+    def observe(self, pgn, seconds):
+        if (h := self.latency.get(pgn)) is None:
+            h = self.latency[pgn] = [0]*(len(self.buckets)+1) + [0.]
+        h[bisect_left(self.buckets, seconds)] += 1
+        h[-1] += seconds
+
+    def snapshot(self):
+        return {"frames": dict(self.frames), "sources": dict(self.sources), "nodecoder": self.nodecoder,
+                "parseerrors": dict(self.parseerrors),
+                "fastpackets": self.fastpackets.stats() if self.fastpackets is not None else None,
+                "transports": self.transports.stats() if self.transports is not None else None,
+                "latency": {pgn: {"buckets": dict(zip((*self.buckets, float("inf")), h[:-1])), "count": sum(h[:-1]), "sum": h[-1]}
+                            for pgn, h in self.latency.items()}}
+
+    def prometheus(self, prefix="canparse"):
+        #Prometheus text exposition format
+        out = [f"# TYPE {prefix}_frames_total counter"]
+        out += [f'{prefix}_frames_total{{pgn="{pgn}"}} {n}' for pgn, n in sorted(self.frames.items())]
+        out.append(f"# TYPE {prefix}_source_frames_total counter")
+        out += [f'{prefix}_source_frames_total{{source="{source}"}} {n}' for source, n in sorted(self.sources.items())]
+        out.append(f"# TYPE {prefix}_nodecoder_frames_total counter")
+        out.append(f"{prefix}_nodecoder_frames_total {self.nodecoder}")
+        out.append(f"# TYPE {prefix}_parse_errors_total counter")
+        out += [f'{prefix}_parse_errors_total{{pgn="{pgn}"}} {n}' for pgn, n in sorted(self.parseerrors.items())]
+        for name, sessions in (("fastpacket", self.fastpackets), ("transport", self.transports)):
+            if sessions is not None:
+                stats = sessions.stats()
+                out.append(f"# TYPE {prefix}_{name}_sessions_open gauge")
+                out.append(f"{prefix}_{name}_sessions_open {stats.pop('sessions')}")
+                out.append(f"# TYPE {prefix}_{name}_total counter")
+                out += [f'{prefix}_{name}_total{{state="{state}"}} {n}' for state, n in stats.items()]
+        out.append(f"# TYPE {prefix}_decode_seconds histogram")
+        for pgn, h in sorted(self.latency.items()):
+            total = 0
+            for le, n in zip((*self.buckets, "+Inf"), h[:-1]):
+                total += n
+                out.append(f'{prefix}_decode_seconds_bucket{{pgn="{pgn}",le="{le}"}} {total}')
+            out.append(f'{prefix}_decode_seconds_sum{{pgn="{pgn}"}} {h[-1]}')
+            out.append(f'{prefix}_decode_seconds_count{{pgn="{pgn}"}} {total}')
+        return "\n".join(out) + "\n"
+
+class lrucache:
+    #decode cache keyed by (pgn, payload) for pgns that repeat the same records, installed by nmea2000.cache()
+    #one bounded LRU per pgn {pgn: entries}, every hit returns a copy so callers may modify their result
+    pgns = {126996: 64, 126998: 64, 127513: 64, 60928: 256, 126993: 256} #product, configuration, battery, address claim, heartbeat
+
+    def __init__(self, pgns=None):
+        self.sizes = dict(self.pgns if pgns is None else pgns)
+        self.entries = {pgn: {} for pgn in self.sizes} #pgn -> {payload: (result, flat)}, oldest first
+        self.hits = dict.fromkeys(self.sizes, 0)
+        self.misses = dict.fromkeys(self.sizes, 0)
+        self.evictions = dict.fromkeys(self.sizes, 0)
+
+    def wrap(self, pgn, decoder):
+        #caching variant of decoder, results that are not dicts (message objects) are passed through
+        entries, maxsize, hits, misses = self.entries[pgn], self.sizes[pgn], self.hits, self.misses
+        immutable = (int, float, str, bytes, bool, type(None))
+        def cached(data):
+            key = bytes(data)
+            if (entry := entries.pop(key, None)) is not None:
+                entries[key] = entry
+                hits[pgn] += 1
+                return entry[0].copy() if entry[1] else deepcopy(entry[0])
+            misses[pgn] += 1
+            ret = decoder(data)
+            if type(ret) is dict:
+                if len(entries) >= maxsize:
+                    del entries[next(iter(entries))]
+                    self.evictions[pgn] += 1
+                flat = all(type(v) in immutable for v in ret.values()) #bytearray, list, dict values need deepcopy
+                entries[key] = (ret.copy() if flat else deepcopy(ret), flat)
+            return ret
+        if (spec := getattr(decoder, "spec", None)) is not None:
+            cached.spec = spec
+        cached.decoder = decoder
+        return cached
+
+    def clear(self):
+        for entries in self.entries.values():
+            entries.clear()
+
+    def stats(self):
+        return {pgn: {"size": len(self.entries[pgn]), "maxsize": self.sizes[pgn], "hits": self.hits[pgn],
+                      "misses": self.misses[pgn], "evictions": self.evictions[pgn]} for pgn in self.sizes}
+
+def field(name, offset, width=1, signed=False, scale=None, lookup=None, lookupname=None, en=None, shift=0, bits=0, na=None):
+    #one entry of a fieldspec table
+    #width in bytes (1,2,3,4,8), bits/shift select a bit field inside it
+    #na: map the "not available" value (all ones, max positive if signed) to None, default for full width fields
+    return (name, offset, width, signed, scale, lookup, lookupname, en, shift, bits, (bits == 0) if na is None else na)
+
+class fieldspec:
+    #decoder compiled from a field table, all fields are read with one Struct.unpack_from
+    codes = {(1, False): "B", (1, True): "b", (2, False): "H", (2, True): "h", (3, False): "HB", (3, True): "Hb",
+             (4, False): "I", (4, True): "i", (8, False): "Q", (8, True): "q"}
+
+    def __init__(self, *fields):
+        self.fields = fields
+        reads = {}
+        for f in fields:
+            reads.setdefault(f[1], (f[2], f[3]))
+            if reads[f[1]] != (f[2], f[3]):
+                raise ValueError(f"conflicting reads at offset {f[1]}")
+        fmt, pos, index = "<", 0, {}
+        for offset, (width, signed) in sorted(reads.items()):
+            if offset < pos:
+                raise ValueError(f"overlapping reads at offset {offset}")
+            fmt += "x"*(offset-pos)
+            index[offset] = len(fmt) - 1 - fmt.count("x")
+            fmt += self.codes[(width, signed)]
+            pos = offset + width
+        self.struct = Struct(fmt)
+        self.size = self.struct.size
+        self.index = index
+        self.messageclass = None
+
+    def __getattr__(self, name):
+        #the decode function is generated on first use, not at import
+        if name in ("decode", "env", "items", "nitems"):
+            self.compile()
+            return self.__dict__[name]
+        if name in ("plan", "packer"):
+            self.buildplan()
+            return self.__dict__[name]
+        raise AttributeError(name)
+
+    def buildplan(self):
+        #encode plan: per read of decode (in struct order) its width, not available value and fields
+        #the packer uses the same layout unsigned, so every read is written as its raw bits
+        reads = {}
+        for name, offset, width, signed, scale, lookup, lookupname, en, shift, bits, na in self.fields:
+            if isinstance(lookup, tuple):
+                lookup = dict(enumerate(lookup))
+            reverse = {v: k for k, v in lookup.items()} if lookupname is not None else None
+            read = reads.setdefault(offset, [width, (1 << 8*width) - 1, []])
+            if not bits and signed:
+                read[1] = (1 << 8*width - 1) - 1 #max positive is not available
+            read[2].append((name, scale, reverse, lookupname, shift, (1 << bits) - 1 if bits else 0))
+        self.plan = [reads[offset] for offset in sorted(reads)]
+        self.packer = Struct(self.struct.format.translate(str.maketrans("bhiq", "BHIQ")))
+
+    def encode(self, values, buffer=None, offset=0):
+        #inverse of decode, writes values into buffer at offset (a new bytearray when None) with one pack_into
+        #missing fields and None are written as not available, lookup names are mapped back to their codes,
+        #bytes decode skips are left as they are, so preallocated buffers should be filled with 0xff
+        if buffer is None:
+            buffer = bytearray(b"\xff" * self.size)
+        get = values.get
+        raws = []
+        for width, na, fields in self.plan:
+            raw = na if fields[0][5] == 0 else (1 << 8*width) - 1
+            for name, scale, reverse, lookupname, shift, mask in fields:
+                v = get(name) if name is not None else None
+                if v is None:
+                    if lookupname is None or (v := reverse.get(get(lookupname))) is None:
+                        continue
+                elif scale is not None:
+                    v = round(v / scale)
+                if mask:
+                    raw = raw & ~(mask << shift) | (v & mask) << shift
+                else:
+                    raw = v & (1 << 8*width) - 1
+            if width == 3:
+                raws += (raw & 0xffff, raw >> 16)
+            else:
+                raws.append(raw)
+        self.packer.pack_into(buffer, offset, *raws)
+        return buffer
+
+    def compile(self):
+        #generate one function per table, scales and lookups are bound through its globals
+        fields, index = self.fields, self.index
+        fmt = self.struct.format
+        nitems = len(fmt) - 1 - fmt.count("x")
+        env = {"unpack_from": self.struct.unpack_from, "size": self.size}
+        items = []
+        for n, (name, offset, width, signed, scale, lookup, lookupname, en, shift, bits, na) in enumerate(fields):
+            v = f"r{index[offset]}"
+            if width == 3:
+                v = f"({v} | r{index[offset]+1} << 16)"
+            if bits:
+                v = f"({v} >> {shift} & {(1 << bits) - 1})" if shift else f"({v} & {(1 << bits) - 1})"
+            raw = v
+            if scale is not None:
+                env[f"s{n}"] = scale
+                v = f"{v} * s{n}"
+            if na:
+                v = f"None if {raw} == {(1 << (bits or 8*width) - signed) - 1} else {v}"
+            if name is not None:
+                items.append((name, v))
+            if lookupname is not None:
+                if isinstance(lookup, tuple):
+                    lookup = dict(enumerate(lookup))
+                if en is not None:
+                    lookup = {**lookup, (1 << en) - 1: "Unavailable"}
+                env[f"l{n}"] = lookup
+                items.append((lookupname, f"l{n}.get({raw})"))
+        src = (f"def decode(data):\n"
+               f"    if len(data) < size:\n"
+               f"        raise IndexError('data too short')\n"
+               f"    {''.join(f'r{k}, ' for k in range(nitems))}= unpack_from(data)\n"
+               f"    return {{{', '.join(f'{k!r}: {v}' for k, v in items)}}}\n")
+        exec(src, env)
+        self.decode = env["decode"]
+        self.decode.spec = self
+        self.env, self.items, self.nitems = env, items, nitems
+
+    def message(self, data):
+        #lazy variant of decode, see message
+        if self.messageclass is None:
+            self.messageclass = self.buildmessage()
+        return self.messageclass(data)
+
+    def buildmessage(self):
+        unpack = f"    {''.join(f'r{k}, ' for k in range(self.nitems))}= self.raw or self.unpack()\n"
+        src = "".join(f"def g{n}(self):\n{unpack}    return {v}\n" for n, (k, v) in enumerate(self.items))
+        env = dict(self.env)
+        exec(src, env)
+        attrs = {k: property(env[f"g{n}"]) for n, (k, v) in enumerate(self.items)}
+        return type("fieldmessage", (fieldmessage,), {"__slots__": (), "spec": self, "fields": tuple(k for k, v in self.items), **attrs})
+
+    def __call__(self, data):
+        return self.decode(data)
+
+    def decodearray(self, payloads):
+        #columnar decode of a (n, size) uint8 array or of single frames as n little endian uint64, needs numpy
+        #not available values become NaN for scaled fields and are masked otherwise, lookups stay codes
+        import numpy as np
+        if isinstance(payloads, np.ndarray) and payloads.dtype == np.uint64 and payloads.ndim == 1:
+            words = payloads
+            if self.size > 8:
+                raise IndexError("data too short")
+        else:
+            payloads = np.ascontiguousarray(payloads, dtype=np.uint8)
+            if payloads.ndim != 2 or payloads.shape[1] < self.size:
+                raise IndexError("data too short")
+            words = payloads.view("<u8")[:, 0] if payloads.shape[1] == 8 else None
+        cols = {}
+        for name, offset, width, signed, scale, lookup, lookupname, en, shift, bits, na in self.fields:
+            if words is not None: #shift and truncate, no byte copies
+                v = (words >> np.uint64(8*offset) if offset else words).astype(f"u{4 if width == 3 else width}")
+                if width == 3:
+                    v = (v & 0xff_ffff).astype(np.int32)
+                    if signed:
+                        v = np.where(v & 0x80_0000, v - 0x100_0000, v)
+                elif signed:
+                    v = v.view(f"i{width}")
+            elif width == 3:
+                v = payloads[:, offset].astype(np.int32) | payloads[:, offset+1].astype(np.int32) << 8 | payloads[:, offset+2].astype(np.int32) << 16
+                if signed:
+                    v = np.where(v & 0x80_0000, v - 0x100_0000, v)
+            else:
+                v = payloads[:, offset:offset+width].copy().view(f"<{'i' if signed else 'u'}{width}")[:, 0]
+            if bits:
+                v = (v >> shift) & ((1 << bits) - 1)
+            if na:
+                missing = v == (1 << (bits or 8*width) - signed) - 1
+            if scale is not None:
+                v = v * float(scale)
+                if na:
+                    v[missing] = np.nan
+            elif na:
+                v = np.ma.masked_array(v, missing)
+            cols[lookupname if name is None else name] = v
+        return cols
+
+class transport:
+    #ISO 11783-3 transport protocol (BAM and RTS/CTS) reassembly, listening passively
+    #TP.DT frames carry no pgn, so sessions are keyed by (source, destination) which the
+    #standard limits to one open session each; the pgn comes from the announcement
+    t1, t2, t3, t4 = 0.75, 1.25, 1.25, 1.05 #ISO timeouts in seconds
+
+    def __init__(self, maxsessions=32):
+        self.maxsessions = maxsessions
+        self.sessions = {} #(source, destination) -> [deadline, pgn, size, fullmask, mask, buffer]
+        self.completed = 0
+        self.aborted = 0
+        self.dropped = 0 #evicted because the table was full
+        self.overwritten = 0 #announced again before completion
+        self.timedout = 0
+        self.orphans = 0 #TP.DT without an announced session
+        self.malformed = 0 #frames too short for their control code, or empty
+
+    def control(self, source, dest, msg, now=None):
+        if now is None:
+            now = monotonic()
+        self.expire(now)
+        sessions = self.sessions
+        code = msg[0] if msg else None
+        if code is None or len(msg) < (8 if code == 16 or code == 32 else 2 if code == 17 else 1):
+            self.malformed += 1
+            return None
+        if code == 16 or code == 32: #RTS, BAM
+            size, packets = msg[1] | msg[2] << 8, msg[3]
+            if packets == 0 or size > 7*packets:
+                return None
+            key = (source, dest)
+            if sessions.pop(key, None) is not None:
+                self.overwritten += 1
+            while len(sessions) >= self.maxsessions:
+                del sessions[next(iter(sessions))]
+                self.dropped += 1
+            pgn = msg[5] | msg[6] << 8 | msg[7] << 16
+            sessions[key] = [now + (self.t1 if code == 32 else self.t3), pgn, size, (1 << packets) - 1, 0, bytearray(7*packets)]
+        elif code == 17: #CTS, sent back by the receiver
+            if (session := sessions.get((dest, source))) is not None:
+                session[0] = now + (self.t2 if msg[1] else self.t4) #0 packets: hold the connection
+        elif code == 255: #Abort, from either side
+            if sessions.pop((source, dest), None) is not None or sessions.pop((dest, source), None) is not None:
+                self.aborted += 1
+        return None
 
-    def receivenext(self):
-        msg = self.bus.recv()
-        priority, source, pgn = self.decodepgn(msg.arbitration_id)
+    def data(self, source, dest, msg, now=None):
+        if now is None:
+            now = monotonic()
+        if not msg:
+            self.malformed += 1
+            return None
+        key = (source, dest)
+        if (session := self.sessions.get(key)) is None:
+            self.orphans += 1
+            return None
+        if now > session[0]:
+            del self.sessions[key]
+            self.timedout += 1
+            self.orphans += 1
+            return None
+        seq = msg[0]
+        bit = 1 << (seq - 1) if seq else 0
+        if bit == 0 or bit > session[3]:
+            return None
+        pnt = 7*(seq - 1)
+        session[5][pnt:pnt+len(msg)-1] = msg[1:8]
+        session[4] |= bit
+        session[0] = now + self.t1
+        if session[4] == session[3]:
+            del self.sessions[key]
+            self.completed += 1
+            return session[1], session[5][:session[2]]
+        return None
 
-        inputca = None
+    def expire(self, now=None):
+        if now is None:
+            now = monotonic()
+        for key in [k for k, s in self.sessions.items() if now > s[0]]:
+            del self.sessions[key]
+            self.timedout += 1
+
+    def stats(self):
+        return {"sessions": len(self.sessions), "completed": self.completed, "aborted": self.aborted, "dropped": self.dropped,
+                "overwritten": self.overwritten, "timedout": self.timedout, "orphans": self.orphans, "malformed": self.malformed}
+
+class canboat:
+    #decoders generated from canboat's pgns.json, see nmea2000.loadcanboat
+    #the json is compiled into plain tuples once and cached with marshal under the sha1 of the file,
+    #later starts hash the file and load the cache instead of parsing it
+    #pgn -> [(type, fields, groups)], one entry per definition (proprietary pgns have several, told apart by Match)
+    #field: (key, kind, bits, signed, scale, offset, lookup, match), groups: [(count field key or None, fields)]
+    version = 1 #part of the cache name, bump when the compiled layout changes
+    kinds = {"FLOAT": "float", "STRING_FIX": "fix", "STRING_LAU": "lau", "STRING_LZ": "lz", "STRING_VAR": "lz",
+             "RESERVED": "skip", "SPARE": "skip", "BINARY": "bin", "BITLOOKUP": "bitlookup", "ISO_NAME": "bin"}
+
+    @classmethod
+    def load(cls, path, cachedir=None):
+        import hashlib
+        import marshal
+        import os
+        with open(path, "rb") as f:
+            raw = f.read()
+        if cachedir is None:
+            cachedir = os.path.join(os.path.expanduser("~"), ".cache", "canparse")
+        cache = os.path.join(cachedir, f"canboat-{hashlib.sha1(raw).hexdigest()}-{cls.version}.marshal")
+        try:
+            with open(cache, "rb") as f:
+                return marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+        import json
+        defs = cls.compile(json.loads(raw))
+        try:
+            os.makedirs(cachedir, exist_ok=True)
+            with open(cache + ".tmp", "wb") as f:
+                marshal.dump(defs, f)
+            os.replace(cache + ".tmp", cache)
+        except OSError: #read only home, compile again next time
+            pass
+        return defs
+
+    @staticmethod
+    def key(name):
+        #"Vessel Heading Reference" -> "vesselHeadingReference" for definitions without Id
+        words = "".join(c if c.isalnum() else " " for c in name).split()
+        return "".join(w.lower() if i == 0 else w[:1].upper() + w[1:] for i, w in enumerate(words)) or "field"
+
+    @classmethod
+    def compile(cls, doc):
+        enums = {e["Name"]: {v["Value"]: v["Name"] for v in e.get("EnumValues", ())} for e in doc.get("LookupEnumerations", ())}
+        bitenums = {e["Name"]: {v["Bit"]: v["Name"] for v in e.get("EnumBitValues", ())} for e in doc.get("LookupBitEnumerations", ())}
+        defs = {}
+        for d in doc["PGNs"]:
+            fields = []
+            for f in d.get("Fields", ()):
+                ftype = f.get("FieldType") or ("LOOKUP" if f.get("EnumValues") else "NUMBER")
+                lookup = enums.get(f.get("LookupEnumeration")) or bitenums.get(f.get("LookupBitEnumeration"))
+                if lookup is None and f.get("EnumValues"): #pgns.json before v5 has the values inline
+                    lookup = {int(v.get("value", v.get("Value"))): v.get("name", v.get("Name")) for v in f["EnumValues"]}
+                scale = float(f.get("Resolution") or 1)
+                match = f.get("Match")
+                fields.append((f.get("Id") or cls.key(f.get("Name", "")), cls.kinds.get(ftype, "num"), int(f.get("BitLength") or 0),
+                               bool(f.get("Signed")), None if scale == 1 else scale, f.get("Offset") or 0, lookup,
+                               None if match is None else int(match)))
+            groups = []
+            for n in (1, 2):
+                if (size := d.get(f"RepeatingFieldSet{n}Size")):
+                    start = d[f"RepeatingFieldSet{n}StartField"] - 1
+                    count = d.get(f"RepeatingFieldSet{n}CountField")
+                    groups.append((start, size, None if count is None else fields[count-1][0]))
+            if not groups and (size := d.get("RepeatingFields")): #older files, the last fields repeat until the end
+                groups.append((len(fields) - size, size, None))
+            head = fields[:groups[0][0]] if groups else fields
+            groups = [(count, fields[start:start+size]) for start, size, count in groups]
+            defs.setdefault(d["PGN"], []).append((d.get("Type") or ("Fast" if d.get("Length", 8) > 8 else "Single"), head, groups))
+        return defs
+
+    @staticmethod
+    def readfields(fields, data, whole, pos, out):
+        #reads fields from bit pos on, returns the new pos or None when a Match field differs
+        end = 8*len(data)
+        ok = True
+        for key, kind, bits, signed, scale, offset, lookup, match in fields:
+            if kind == "lau" or kind == "lz": #length prefixed, byte aligned
+                p = (pos + 7) >> 3
+                if p >= len(data):
+                    return end if ok else None
+                if kind == "lau": #total length including itself and the encoding byte
+                    n = max(data[p], 2)
+                    text = bytes(data[p+2:p+n])
+                    out[key] = text.decode("utf-16-le" if data[p+1] == 0 else "utf-8", "replace")
+                else:
+                    n = data[p] + 1
+                    out[key] = bytes(data[p+1:p+n]).rstrip(b"\x00").decode("utf-8", "replace")
+                pos = 8*(p + n)
+                continue
+            if bits == 0 or pos + bits > end:
+                break
+            raw = whole >> pos & (1 << bits) - 1
+            pos += bits
+            if kind == "skip":
+                continue
+            if kind == "num":
+                if match is not None and raw != match:
+                    ok = False
+                if lookup is not None:
+                    out[key] = raw
+                    out[key + "Name"] = lookup.get(raw)
+                    continue
+                if signed and raw >> bits - 1:
+                    raw -= 1 << bits
+                if bits > 1 and raw == ((1 << bits - 1) - 1 if signed else (1 << bits) - 1):
+                    out[key] = None
+                else:
+                    out[key] = (raw * scale if scale is not None else raw) + offset
+            elif kind == "fix":
+                text = raw.to_bytes(bits >> 3, "little")
+                out[key] = text[:f] if (f := text.find(b"\xff")) >= 0 else text
+            elif kind == "float":
+                out[key] = None if raw == 0xffff_ffff else unpack("<f", raw.to_bytes(4, "little"))[0]
+            elif kind == "bitlookup":
+                out[key] = raw
+                out[key + "Name"] = [name for bit, name in lookup.items() if raw >> bit & 1] if lookup else []
+            else:
+                out[key] = raw.to_bytes((bits + 7) >> 3, "little").hex(" ")
+        return pos if ok else None
+
+    @classmethod
+    def decoder(cls, definitions):
+        #decode function over the definitions of one pgn, the first one whose Match fields fit wins
+        readfields = cls.readfields
+        def decode(data):
+            whole = int.from_bytes(data, "little")
+            end = 8*len(data)
+            ret = None
+            for ptype, head, groups in definitions:
+                out = {}
+                if (pos := readfields(head, data, whole, 0, out)) is None:
+                    ret = ret or out
+                    continue
+                for n, (count, fields) in enumerate(groups):
+                    items = []
+                    repeat = out.get(count) if count is not None else None
+                    while pos < end and (repeat is None or len(items) < repeat):
+                        item = {}
+                        if (nxt := readfields(fields, data, whole, pos, item)) is None or nxt == pos or not item:
+                            break
+                        items.append(item)
+                        pos = nxt
+                    out["list" if n == 0 else f"list{n+1}"] = items
+                return out
+            return ret
+        return decode
+
+class nmea2000:
+    bus = None
+    stubs = {129029, 129283, 129284, 129539, 129285} #decoders that still return {}, loadcanboat replaces them
 
-        #if pgn != 126208:
-        #    return None
+    def __init__(self, canbus, fastpackets=None, lazy=False, transports=None):
+        self.bus=canbus
+        self.fastpackets = fastpacket() if fastpackets is None else fastpackets
+        self.transports = transport() if transports is None else transports
+        self.lazy = lazy #decoders return message objects instead of dicts where available
+        self.decoders = self.builddecoders()
+        self.subscriptions = {} #(pgn, source or None) -> [callback]
+        self.metrics = None
+        self.decodecache = None
+        self.encoders = {} #pgn -> (fastpacket, encode function), filled by encoder()
+        self.fragmenter = fragmenter()
+        self.maxfilters = None #number of hardware filters the controller offers
+
+    def framekind(self, pgn):
         #single frame
-        if (pgn >= 59392 and pgn <= 60928) or pgn == 61184 or (pgn >= 61440 and pgn <= 65279) or (pgn >= 65280 and pgn <= 65535) or (pgn >= 126208 and pgn <= 126464):
-                if (ca := getattr(self, f"decsp{pgn}",None)) is None and pgn == 61184 or (pgn >= 65280 and pgn <= 65535):
-                    inputca = (self.retstandard, msg.data)
-                else:
-                    inputca = (ca, msg.data)
+        if (pgn >= 59392 and pgn <= 60928) or pgn == 61184 or (pgn >= 61440 and pgn <= 65535) or (pgn >= 126208 and pgn < 126464):
+            return "single"
         #fast packet
-        elif pgn == 126720 or (pgn >= 130816 and pgn <= 131071):
-            if (data := self.pushfastpacket(pgn,msg.data)) is not None:
-                if (ca := getattr(self, f"decfp{pgn}",None)) is None:
-                    inputca = (self.retstandard, data)
-                else:
-                    inputca = (ca, data)
-        elif pgn >= 126976 and pgn <= 130815:
-            if (ca:= getattr(self, f"decsp{pgn}",None)) is not None:
-                inputca = (ca, msg.data)
-            elif (ca:= getattr(self, f"decfp{pgn}",None)) is not None:
-                if (data := self.pushfastpacket(pgn, msg.data)) is not None:
-                    inputca = (ca, data)
-
-        if inputca is not None:
-            try:
-                data = inputca[0](inputca[1])
-            except IndexError:
-                data = self.retparseerror(inputca[1])
-            return (pgn,data)
+        if pgn == 126464 or pgn == 126720 or (pgn >= 130816 and pgn <= 131071):
+            return "fast"
+        #mixed single/fast
+        if pgn >= 126976 and pgn <= 130815:
+            return "mixed"
         return None
+
+    def builddecoders(self):
+        #pgn -> (fastpacket, decoder), built once so receivenext only needs a dict lookup
+        #fastpacket 2 marks the ISO transport protocol frames, they go to pushtransport
+        table = {}
+        standard = proprietarymessage if self.lazy else self.retstandard
+        for pgn in (61184, *range(65280, 65536)):
+            table[pgn] = (False, standard)
+        for pgn in (126720, *range(130816, 131072)):
+            table[pgn] = (True, standard)
+        names = [n for n in dir(self) if n[:5] in ("decsp", "decfp") and n[5:].isdigit()]
+        for name in sorted(names, key=lambda n: n[:5] == "decsp"): #decsp wins over decfp
+            pgn = int(name[5:])
+            kind = self.framekind(pgn)
+            decoder = getattr(self, name)
+            if isinstance(decoder, fieldspec):
+                decoder = decoder.message if self.lazy else decoder.decode #skip the __call__ indirection
+            elif self.lazy and pgn in lazymessages:
+                decoder = lazymessages[pgn]
+            if name[:5] == "decsp" and kind in ("single", "mixed"):
+                table[pgn] = (False, decoder)
+            elif name[:5] == "decfp" and kind in ("fast", "mixed"):
+                table[pgn] = (True, decoder)
+        for dest in range(256): #TP.CM and TP.DT to every destination
+            table[60416 | dest] = (2, table[60416][1])
+            table[60160 | dest] = (2, table[60160][1])
+        for pgn in [p for p in table if len(self.destinations(p)) > 1]: #other PDU1 pgns, e.g. address claims to 0xff
+            for key in self.destinations(pgn):
+                table.setdefault(key, table[pgn])
+        return table
+
+    @staticmethod
+    def destinations(pgn):
+        #decoder table keys of pgn, PDU1 pgns (PF < 240) keep the destination in the low byte like decodepgn
+        return range(pgn, pgn + 256) if (pgn >> 8) & 0xff < 240 and not pgn & 0xff else (pgn,)
+
+    def isstandard(self, decoder):
+        #the placeholder decoder builddecoders puts on proprietary pgns
+        return decoder is proprietarymessage or getattr(decoder, "__func__", None) is nmea2000.retstandard
+
+    def register(self, pgn, decoder, fastpacket=False):
+        for key in self.destinations(pgn):
+            self.decoders[key] = (fastpacket, decoder)
+
+    def loadcanboat(self, path, cachedir=None, replace=False):
+        #registers decoders generated from canboat's pgns.json for every pgn without a decoder (and the stubs and
+        #the generic retstandard of proprietary pgns), replace=True overrides the built in ones as well,
+        #returns the number of registered pgns
+        n = 0
+        for pgn, definitions in canboat.load(path, cachedir).items():
+            if not replace and (entry := self.decoders.get(pgn)) is not None and pgn not in self.stubs and not self.isstandard(entry[1]):
+                continue
+            self.register(pgn, canboat.decoder(definitions), definitions[0][0] == "Fast")
+            self.encoders.pop(pgn, None)
+            n += 1
+        return n
+
+    def unregister(self, pgn):
+        entry = self.decoders.get(pgn)
+        for key in self.destinations(pgn):
+            self.decoders.pop(key, None)
+        return entry
+
+    def decodebatch(self, ids, timestamps, payloads):
+        #decode arrays of logged frames (arbitration ids, timestamps, n x 8 payloads), needs numpy
+        #returns {pgn: {"timestamp": ..., "source": ..., field: column}}, decoders without a
+        #fieldspec return their dicts in a "data" list
+        import numpy as np
+        ids = np.asarray(ids, dtype=np.uint32)
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        payloads = np.ascontiguousarray(payloads, dtype=np.uint8).reshape(len(ids), 8)
+        words = payloads.view("<u8")[:, 0] #one element per frame, gathers much faster than 8 byte rows
+        pgns = (ids & 0x3ffff00) >> 8
+        sources = (ids & 0xff).astype(np.uint8)
+        #pgns are 18 bit, counting them is O(n); the stable sort on small codes is a radix sort
+        counts = np.bincount(pgns, minlength=1 << 18)
+        uniq = np.flatnonzero(counts)
+        codes = np.zeros(1 << 18, dtype=np.uint16)
+        codes[uniq] = np.arange(len(uniq), dtype=np.uint16)
+        order = np.argsort(codes[pgns], kind="stable") #keeps time order inside a pgn for reassembly
+        bounds = np.concatenate(([0], np.cumsum(counts[uniq])))
+        ret = {}
+        for k, pgn in enumerate(uniq.tolist()):
+            if (entry := self.decoders.get(pgn)) is None:
+                continue
+            fast, decoder = entry
+            spec = getattr(decoder, "spec", None) or getattr(decoder, "__self__", decoder) #decode function, message class or fieldspec.message
+            if not isinstance(spec, fieldspec):
+                spec = None
+            rows = order[bounds[k]:bounds[k+1]]
+            ts, src = timestamps[rows], sources[rows]
+            if fast != 1 and spec is not None and spec.size <= 8:
+                ret[pgn] = {"timestamp": ts, "source": src, **spec.decodearray(words[rows])}
+                continue
+            data = words[rows].view(np.uint8).reshape(len(rows), 8)
+            if fast == 1:
+                ts, src, data = self.reassemblebatch(pgn, ts, src, data, None if spec is None else spec.size)
+            if spec is not None and len(data) and data.shape[1] >= spec.size:
+                ret[pgn] = {"timestamp": ts, "source": src, **spec.decodearray(data)}
+            else:
+                ret[pgn] = {"timestamp": ts, "source": src, "data": [self.decodeone(decoder, bytearray(d)) for d in data]}
+        return ret
+
+    def reassemblebatch(self, pgn, timestamps, sources, payloads, size=None):
+        #bulk fast packet reassembly of one pgn: packets whose frames arrive in order (per source and session
+        #counter) are cut out with array operations, the remaining frames go through a private fastpacket
+        #returns timestamps, sources and payloads of the completed packets in completion order, the payloads
+        #as a (n, size) array when size is given (shorter packets are dropped), else as a list of bytearrays
+        import numpy as np
+        n = len(timestamps)
+        head = payloads[:, 0]
+        key = sources.astype(np.uint16) << 3 | head >> 5 #11 bits, the stable sort is a radix sort
+        order = np.argsort(key, kind="stable") #time order inside each (source, session counter)
+        k, fc = key[order], (head & 0x1f).astype(np.int32)[order]
+        cont = np.zeros(n, dtype=bool)
+        cont[1:] = (k[1:] == k[:-1]) & (fc[1:] == fc[:-1] + 1)
+        starts = np.flatnonzero(~cont) #runs of consecutive frame counters
+        runs = np.diff(np.append(starts, n))
+        datalen = payloads[order[starts], 1].astype(np.int32)
+        need = np.maximum((datalen + 7) // 7, 1)
+        ok = (fc[starts] == 0) & (runs >= need)
+        last = order[np.minimum(starts + need - 1, n - 1)]
+        ok &= timestamps[last] - timestamps[order[starts]] <= self.fastpackets.timeout
+        starts, need, datalen, last = starts[ok], need[ok], datalen[ok], last[ok]
+        used = np.zeros(n, dtype=bool)
+        used[order[np.repeat(starts - np.cumsum(need) + need, need) + np.arange(need.sum())]] = True
+
+        if size is not None:
+            keep = datalen >= size
+            j = np.arange(size)
+            frame = np.where(j < 6, 0, 1 + (j - 6) // 7)
+            col = np.where(j < 6, 2 + j, 1 + (j - 6) % 7)
+            data = payloads[order[starts[keep, None] + frame], col]
+            done, ts, src = last[keep], timestamps[last[keep]], sources[last[keep]]
+        else:
+            data = [bytearray((payloads[order[s], 2:8].tobytes() + payloads[order[s+1:s+m], 1:8].tobytes())[:d])
+                    for s, m, d in zip(starts.tolist(), need.tolist(), datalen.tolist())]
+            done, ts, src = last, timestamps[last], sources[last]
+
+        #out of order, interleaved or incomplete packets
+        fp = fastpacket(self.fastpackets.maxsessions, self.fastpackets.timeout)
+        rest, raw = [], payloads.tobytes()
+        for i in np.flatnonzero(~used).tolist():
+            if (d := fp.push(int(sources[i]), pgn, raw[8*i:8*i+8], float(timestamps[i]))) is not None and (size is None or len(d) >= size):
+                rest.append((i, d))
+        if rest:
+            idx = np.array([i for i, d in rest])
+            done = np.concatenate((done, idx))
+            ts, src = np.concatenate((ts, timestamps[idx])), np.concatenate((src, sources[idx]))
+            if size is not None:
+                data = np.concatenate((data, np.frombuffer(b"".join(bytes(d[:size]) for i, d in rest), dtype=np.uint8).reshape(len(rest), size)))
+            else:
+                data = data + [d for i, d in rest]
+        order = np.argsort(done, kind="stable")
+        return ts[order], src[order], (data[order] if size is not None else [data[i] for i in order.tolist()])
+
+    def decodeone(self, decoder, data):
+        try:
+            return decoder(data)
+        except IndexError:
+            return self.retparseerror(data)
+
+    def subscribe(self, pgn, callback, source=None):
+        #callback(pgn, source, data) for every decoded pgn (from source), see dispatch
+        self.subscriptions.setdefault((pgn, source), []).append(callback)
+        self.applyfilters()
+
+    def unsubscribe(self, pgn, callback, source=None):
+        if (callbacks := self.subscriptions.get((pgn, source))) is not None and callback in callbacks:
+            callbacks.remove(callback)
+            if not callbacks:
+                del self.subscriptions[(pgn, source)]
+            self.applyfilters()
+
+    def canfilters(self, maxfilters=None):
+        #python-can filters for the subscriptions, same bit layout as decodepgn, any priority
+        #above maxfilters the closest filters are merged into wider masks, dispatch drops the extra frames
+        #TP.CM/TP.DT frames (from the subscribed sources) always pass, the pgn they carry is known after reassembly
+        filters = []
+        for pgn, source in self.subscriptions:
+            if source is None:
+                filters += [(pgn << 8, 0x3ffff00), (0xEB0000, 0x3ff0000), (0xEC0000, 0x3ff0000)]
+            else:
+                filters += [(pgn << 8 | source, 0x3ffffff), (0xEB0000 | source, 0x3ff00ff), (0xEC0000 | source, 0x3ff00ff)]
+        filters = sorted(set(filters))
+        while maxfilters is not None and len(filters) > max(maxfilters, 1):
+            best = None
+            for i in range(len(filters)):
+                for j in range(i+1, len(filters)):
+                    mask = filters[i][1] & filters[j][1] & ~(filters[i][0] ^ filters[j][0])
+                    if best is None or mask.bit_count() > best[0].bit_count():
+                        best = (mask, i, j)
+            mask, i, j = best
+            merged = (filters[i][0] & mask, mask)
+            filters = sorted(set(f for k, f in enumerate(filters) if k not in (i, j)) | {merged})
+        return [{"can_id": can_id, "can_mask": mask, "extended": True} for can_id, mask in filters]
+
+    def applyfilters(self):
+        if self.bus is not None and hasattr(self.bus, "set_filters"):
+            self.bus.set_filters(self.canfilters(self.maxfilters) if self.subscriptions else None)
+
+    def dispatch(self, timeout=None):
+        #receive one frame and hand it to the subscribers, frames nobody wants are not decoded
+        #returns the number of callbacks called
+        if (msg := self.bus.recv(timeout)) is None:
+            return 0
+        arb = msg.arbitration_id
+        pgn, source = (arb & 0x3ffff00) >> 8, arb & 0xff
+        subscriptions = self.subscriptions
+        if istransport(arb): #always reassembled, the transported pgn picks the callbacks
+            if (ret := self.decodeframe(arb, msg.data, msg.timestamp)) is None:
+                return 0
+            pgn = ret[0]
+            callbacks = subscriptions.get((pgn, None), []) + subscriptions.get((pgn, source), [])
+        else:
+            callbacks = subscriptions.get((pgn, None), []) + subscriptions.get((pgn, source), [])
+            if not callbacks or (ret := self.decodeframe(arb, msg.data, msg.timestamp)) is None:
+                return 0
+        for callback in callbacks:
+            callback(pgn, source, ret[1])
+        return len(callbacks)
+
+    async def __aiter__(self):
+        #async for pgn, data in decoder, the notifier stops when the loop ends
+        receiver = asyncreceiver(self).start()
+        try:
+            async for ret in receiver:
+                yield ret
+        finally:
+            receiver.close()
+
+    def receivenext(self):
+        return self.decodemessage(self.bus.recv())
+
+    def decodemessages(self, messages):
+        #decode any iterable of can.Message, e.g. a replaybus
+        for msg in messages:
+            if (ret := self.decodemessage(msg)) is not None:
+                yield ret
+
+    def decodemessage(self, msg):
+        if msg is None:
+            return None
+        return self.decodeframe(msg.arbitration_id, msg.data, msg.timestamp)
+
+    def cache(self, enable=True):
+        #switch the decode cache on (True, {pgn: entries} or an lrucache, returns it) or off
+        if self.decodecache is not None:
+            for key in [k for pgn in self.decodecache.sizes for k in self.destinations(pgn)]:
+                if (entry := self.decoders.get(key)) is not None and hasattr(entry[1], "decoder"):
+                    self.decoders[key] = (entry[0], entry[1].decoder)
+            self.decodecache = None
+        if enable is False or enable is None:
+            return None
+        c = enable if isinstance(enable, lrucache) else lrucache(None if enable is True else enable)
+        for pgn in c.sizes:
+            for key in self.destinations(pgn): #PDU1 pgns share one LRU over all destinations
+                if (entry := self.decoders.get(key)) is not None:
+                    self.decoders[key] = (entry[0], c.wrap(pgn, entry[1]))
+        self.decodecache = c
+        return c
+
+    def instrument(self, enable=True):
+        #switch runtime metrics on (returns the metrics object) or off
+        #the metered path replaces decodeframe on the instance, so switched off it costs nothing
+        if enable:
+            self.metrics = enable if isinstance(enable, metrics) else metrics(self.fastpackets, transports=self.transports)
+            self.decodeframe = self.decodeframemetered
+        else:
+            self.metrics = None
+            self.__dict__.pop("decodeframe", None)
+        return self.metrics
+
+    def decodeframemetered(self, arbitration_id, data, timestamp=None):
+        m = self.metrics
+        priority, source, pgn = self.decodepgn(arbitration_id)
+        m.frames[pgn] = m.frames.get(pgn, 0) + 1
+        m.sources[source] = m.sources.get(source, 0) + 1
+
+        if (entry := self.decoders.get(pgn)) is None:
+            m.nodecoder += 1
+            return None
+        fastpacket, decoder = entry
+        if fastpacket == 2:
+            return self.pushtransport(pgn, source, data, timestamp)
+        if fastpacket and (data := self.pushfastpacket(pgn, data, source, timestamp)) is None:
+            return None
+
+        start = perf_counter()
+        try:
+            ret = decoder(data)
+        except IndexError:
+            m.parseerrors[pgn] = m.parseerrors.get(pgn, 0) + 1
+            ret = self.retparseerror(data)
+        m.observe(pgn, perf_counter() - start)
+        return (pgn,ret)
+
+    def decodeframe(self, arbitration_id, data, timestamp=None):
+        priority, source, pgn = self.decodepgn(arbitration_id)
+
+        if (entry := self.decoders.get(pgn)) is None:
+            return None
+        fastpacket, decoder = entry
+        if fastpacket == 2:
+            return self.pushtransport(pgn, source, data, timestamp)
+        if fastpacket and (data := self.pushfastpacket(pgn, data, source, timestamp)) is None:
+            return None
+
+        return (pgn,self.decodeone(decoder, data))
     #strings
     def GfixString(self, data, idx, length):
         d = data[idx:idx+length]
@@ -64,7 +1527,7 @@ class nmea2000:
         return None if (d := unpack("H",msg[idx:idx+2])[0]) == 0xFFFF else d
 
     def Gu24(self, msg, idx):
-        return None if (d := (unpack("H",msg[idx+1:idx+3])[0]<<8) | msg[idx+2]) == 0xFF_FFFF else d
+        return None if (d := int.from_bytes(msg[idx:idx+3], "little")) == 0xFF_FFFF else d
 
     def Gu32(self, msg, idx):
         return None if (d := unpack("I",msg[idx:idx+4])[0]) == 0xFFFF_FFFF else d 
@@ -77,16 +1540,16 @@ class nmea2000:
         return None if msg[idx] == 0x7f else unpack("b",msg[idx:idx+1])[0]
 
     def Gi16(self, msg, idx):
-        return None if msg[idx:idx+2] == bytearray((0xff,0x7f)) else unpack("h",msg[idx:idx+2])[0]
+        return None if (d := unpack("h",msg[idx:idx+2])[0]) == 0x7FFF else d
 
     def Gi24(self, msg, idx):
-        return None if msg[idx:idx+3] == bytearray((0xff,0xff,0x7f)) else (unpack("h",msg[idx+1:idx+3])[0]<<8) | msg[idx+2]
+        return None if (d := int.from_bytes(msg[idx:idx+3], "little", signed=True)) == 0x7F_FFFF else d
 
     def Gi32(self, msg, idx):
-        return None if msg[idx:idx+4] == bytearray((0xff,0xff,0xff,0x7f)) else unpack("i",msg[idx:idx+4])[0]
+        return None if (d := unpack("i",msg[idx:idx+4])[0]) == 0x7FFF_FFFF else d
 
     def Gi64(self, msg, idx):
-        return None if msg[idx:idx+8] == bytearray((0xff,0xff,0xff,0xff,0xff,0xff,0xff,0x7f)) else unpack("q",msg[idx:idx+8])[0]
+        return None if (d := unpack("q",msg[idx:idx+8])[0]) == 0x7FFF_FFFF_FFFF_FFFF else d
 
     #signed double
     def Gd8(self, msg, idx, calc=1.):
@@ -122,28 +1585,20 @@ class nmea2000:
     def Gud32(self, msg,idx, calc=1.):
         return None if (d := self.Gu32(msg, idx)) is None else d * calc 
 
-    def pushfastpacket(self, pgn, msg):
-        sc = msg[0] >> 5 #session counter
-        fc = msg[0] & 0x1f #frame counter
+    def pushfastpacket(self, pgn, msg, source=0, timestamp=None):
+        return self.fastpackets.push(source, pgn, msg, timestamp)
 
-        bufferid = pgn*8+sc
+    def reassembletransport(self, pgn, source, msg, timestamp=None):
+        #TP.CM/TP.DT frame, returns (transported pgn, payload) once it is complete
+        if pgn & 0x3ff00 == 60416:
+            return self.transports.control(source, pgn & 0xff, msg, timestamp)
+        return self.transports.data(source, pgn & 0xff, msg, timestamp)
 
-        if fc == 0:
-            datalen = msg[1]
-            if datalen == 0:
-                return ""
-            data=[None]*int(ceil((datalen - 6) / 7)+1)
-            data[0]=msg[2:]
-            self.buffer[bufferid]=(datalen, data)
-        else:
-            pnt = 7*fc+6
-            if bufferid in self.buffer:
-                self.buffer[bufferid][1][fc]=msg[1:]
-                if all(v is not None for v in self.buffer[bufferid][1]):
-                    ret = b''.join(self.buffer[bufferid][1])[:self.buffer[bufferid][0]]
-                    del self.buffer[bufferid]
-                    return ret
-        return None
+    def pushtransport(self, pgn, source, msg, timestamp=None):
+        #TP.CM/TP.DT frame, returns the decoded transported pgn once it is complete
+        if (ret := self.reassembletransport(pgn, source, msg, timestamp)) is None or (entry := self.decoders.get(ret[0])) is None or entry[0] == 2:
+            return None
+        return (ret[0], self.decodeone(entry[1], ret[1]))
 
     def getname(self, tup, idx, en = None, notfound = "Unavailable"):
         if isinstance(tup, tuple):
@@ -160,26 +1615,102 @@ class nmea2000:
     def decodepgn(self, arb):
         return (arb & 0x1c000000) >> 26, arb & 0x000000ff, (arb & 0x3ffff00) >> 8
 
-    manufactorcode = {69: "ARKS Enterprises, Inc.", 78: "FW Murphy/Enovation Controls", 80: "Twin Disc", 85: "Kohler Power Systems", 88: "Hemisphere GPS Inc", 116: "BEP Marine", 135: "Airmar", 137: "Maretron", 140: "Lowrance", 144: "Mercury Marine", 147: "Nautibus Electronic GmbH", 148: "Blue Water Data", 154: "Westerbeke", 161: "Offshore Systems (UK) Ltd.", 163: "Evinrude/BRP", 165: "CPAC Systems AB", 168: "Xantrex Technology Inc.", 172: "Yanmar Marine", 174: "Volvo Penta", 175: "Honda Marine", 176: "Carling Technologies Inc. (Moritz Aerospace)", 185: "Beede Instruments", 192: "Floscan Instrument Co. Inc.", 193: "Nobletec", 198: "Mystic Valley Communications", 199: "Actia", 200: "Honda Marine", 201: "Disenos Y Technologia", 211: "Digital Switching Systems", 215: "Xintex/Atena", 224: "EMMI NETWORK S.L.", 225: "Honda Marine", 228: "ZF", 229: "Garmin", 233: "Yacht Monitoring Solutions", 235: "Sailormade Marine Telemetry/Tetra Technology LTD", 243: "Eride", 250: "Honda Marine", 257: "Honda Motor Company LTD", 272: "Groco", 273: "Actisense", 274: "Amphenol LTW Technology", 275: "Navico", 283: "Hamilton Jet", 285: "Sea Recovery", 286: "Coelmo SRL Italy", 295: "BEP Marine", 304: "Empir Bus", 305: "NovAtel", 306: "Sleipner Motor AS", 307: "MBW Technologies", 311: "Fischer Panda", 315: "ICOM", 328: "Qwerty", 329: "Dief", 341: "Boening Automationstechnologie GmbH & Co. KG", 345: "Korean Maritime University", 351: "Thrane and Thrane", 355: "Mastervolt", 356: "Fischer Panda Generators", 358: "Victron Energy", 370: "Rolls Royce Marine", 373: "Electronic Design", 374: "Northern Lights", 378: "Glendinning", 381: "B & G", 384: "Rose Point Navigation Systems", 385: "Johnson Outdoors Marine Electronics Inc Geonav", 394: "Capi 2", 396: "Beyond Measure", 400: "Livorsi Marine", 404: "ComNav", 409: "Chetco", 419: "Fusion Electronics", 421: "Standard Horizon", 422: "True Heading AB", 426: "Egersund Marine Electronics AS", 427: "em-trak Marine Electronics", 431: "Tohatsu Co, JP", 437: "Digital Yacht", 438: "Comar Systems Limited", 440: "Cummins", 443: "VDO (aka Continental-Corporation)", 451: "Parker Hannifin aka Village Marine Tech", 459: "Alltek Marine Electronics Corp", 460: "SAN GIORGIO S.E.I.N", 466: "Veethree Electronics & Marine", 467: "Humminbird Marine Electronics", 470: "SI-TEX Marine Electronics", 471: "Sea Cross Marine AB", 475: "GME aka Standard Communications Pty LTD", 476: "Humminbird Marine Electronics", 478: "Ocean Sat BV", 481: "Chetco Digitial Instruments", 493: "Watcheye", 499: "Lcj Capteurs", 502: "Attwood Marine", 503: "Naviop S.R.L.", 504: "Vesper Marine Ltd", 510: "Marinesoft Co. LTD", 517: "NoLand Engineering", 518: "Transas USA", 529: "National Instruments Korea", 532: "Onwa Marine", 571: "Marinecraft (South Korea)", 573: "McMurdo Group aka Orolia LTD", 578: "Advansea", 579: "KVH", 580: "San Jose Technology", 583: "Yacht Control", 586: "Suzuki Motor Corporation", 591: "US Coast Guard", 595: "Ship Module aka Customware", 600: "Aquatic AV", 605: "Aventics GmbH", 606: "Intellian", 612: "SamwonIT", 614: "Arlt Tecnologies", 637: "Bavaria Yacts", 641: "Diverse Yacht Services", 644: "Wema U.S.A dba KUS", 645: "Garmin", 658: "Shenzhen Jiuzhou Himunication", 688: "Rockford Corp", 704: "JL Audio", 715: "Autonnic", 717: "Yacht Devices", 734: "REAP Systems", 735: "Au Electronics Group", 739: "LxNav", 743: "DaeMyung", 744: "Woosung", 773: "Clarion US", 776: "HMI Systems", 777: "Ocean Signal", 778: "Seekeeper", 781: "Poly Planar", 785: "Fischer Panda DE", 795: "Broyda Industries", 796: "Canadian Automotive", 797: "Tides Marine", 798: "Lumishore", 799: "Still Water Designs and Audio", 802: "BJ Technologies (Beneteau)", 803: "Gill Sensors", 811: "Blue Water Desalination", 815: "FLIR", 824: "Undheim Systems", 838: "TeamSurv", 844: "Fell Marine", 847: "Oceanvolt", 862: "Prospec", 868: "Data Panel Corp", 890: "L3 Technologies", 894: "Rhodan Marine Systems", 896: "Nexfour Solutions", 905: "ASA Electronics", 909: "Marines Co (South Korea)", 911: "Nautic-on", 930: "Ecotronix", 962: "Timbolier Industries", 963: "TJC Micro", 968: "Cox Powertrain", 969: "Blue Seas", 1417: "Revatek", 1850: "Teleflex Marine (SeaStar Solutions)", 1851: "Raymarine", 1852: "Navionics", 1853: "Japan Radio Co", 1854: "Northstar Technologies", 1855: "Furuno", 1856: "Trimble", 1857: "Simrad", 1858: "Litton", 1859: "Kvasar AB", 1860: "MMP", 1861: "Vector Cantech", 1862: "Yamaha Marine", 1863: "Faria Instruments"}
+    @staticmethod
+    def Pna(values, name, na, scale=None):
+        #raw value of name for packing, na (the "not available" pattern) when it is missing or None
+        if (v := values.get(name)) is None:
+            return na
+        return round(v if scale is None else v / scale)
+
+    @staticmethod
+    def Pcode(values, name, textname, texts, na):
+        #lookup code from name, or from its text in textname when only that is given
+        if (v := values.get(name)) is not None:
+            return v
+        if (text := values.get(textname)) is not None and text in texts:
+            return texts.index(text)
+        return na
+
+    @staticmethod
+    def Ptext(value):
+        return value.encode() if isinstance(value, str) else bytes(value or b"")
+
+    def encodepgn(self, priority, source, pgn, destination=None):
+        #inverse of decodepgn, destination goes into the low byte of PDU1 pgns
+        if destination is not None and (pgn >> 8) & 0xff < 240:
+            pgn = (pgn & 0x3ff00) | destination
+        return (priority & 7) << 26 | (pgn & 0x3ffff) << 8 | source & 0xff
+
+    def encoder(self, pgn):
+        #(fastpacket, encode(values, buffer=None)) for pgn, from the fieldspec tables and the encsp/encfp methods
+        if (entry := self.encoders.get(pgn)) is not None:
+            return entry
+        if (decoder := self.decoders.get(pgn)) is None or decoder[0] == 2:
+            raise KeyError(f"no encoder for pgn {pgn}")
+        encode = getattr(self, f"encsp{pgn}", None) or getattr(self, f"encfp{pgn}", None)
+        if encode is None:
+            spec = getattr(decoder[1], "spec", None) or getattr(decoder[1], "__self__", decoder[1])
+            if not isinstance(spec, fieldspec):
+                raise KeyError(f"no encoder for pgn {pgn}")
+            encode = spec.encode
+        entry = self.encoders[pgn] = (decoder[0], encode)
+        return entry
+
+    def encode(self, pgn, values, buffer=None):
+        return self.encoder(pgn)[1](values, buffer)
+
+    def encodeframes(self, pgn, values, source=0, priority=6, destination=None):
+        #can.Message list of one pgn, single frames are padded to 8 bytes, fast packets fragmented
+        fast, encode = self.encoder(pgn)
+        data = encode(values)
+        arb = self.encodepgn(priority, source, pgn, destination)
+        if fast:
+            return [can.Message(arbitration_id=arb, data=frame, is_extended_id=True) for frame in self.fragmenter.frames(source, pgn, data)]
+        if len(data) < 8:
+            data += b"\xff" * (8 - len(data))
+        return [can.Message(arbitration_id=arb, data=data, is_extended_id=True)]
+
+    def send(self, pgn, values, source=0, priority=6, destination=None, timeout=1.0):
+        self.sendframes(self.encodeframes(pgn, values, source, priority, destination), timeout)
+
+    def sendframes(self, frames, timeout=1.0):
+        #sends a batch of can.Message back to back, a full transmit queue is retried until timeout
+        send = self.bus.send
+        for msg in frames:
+            try:
+                send(msg)
+            except can.CanOperationError:
+                deadline = monotonic() + timeout
+                while True:
+                    sleep(0.0002)
+                    try:
+                        send(msg)
+                        break
+                    except can.CanOperationError:
+                        if monotonic() > deadline:
+                            raise
+
+    @lazytable
+    def manufactorcode():
+        return {69: "ARKS Enterprises, Inc.", 78: "FW Murphy/Enovation Controls", 80: "Twin Disc", 85: "Kohler Power Systems", 88: "Hemisphere GPS Inc", 116: "BEP Marine", 135: "Airmar", 137: "Maretron", 140: "Lowrance", 144: "Mercury Marine", 147: "Nautibus Electronic GmbH", 148: "Blue Water Data", 154: "Westerbeke", 161: "Offshore Systems (UK) Ltd.", 163: "Evinrude/BRP", 165: "CPAC Systems AB", 168: "Xantrex Technology Inc.", 172: "Yanmar Marine", 174: "Volvo Penta", 175: "Honda Marine", 176: "Carling Technologies Inc. (Moritz Aerospace)", 185: "Beede Instruments", 192: "Floscan Instrument Co. Inc.", 193: "Nobletec", 198: "Mystic Valley Communications", 199: "Actia", 200: "Honda Marine", 201: "Disenos Y Technologia", 211: "Digital Switching Systems", 215: "Xintex/Atena", 224: "EMMI NETWORK S.L.", 225: "Honda Marine", 228: "ZF", 229: "Garmin", 233: "Yacht Monitoring Solutions", 235: "Sailormade Marine Telemetry/Tetra Technology LTD", 243: "Eride", 250: "Honda Marine", 257: "Honda Motor Company LTD", 272: "Groco", 273: "Actisense", 274: "Amphenol LTW Technology", 275: "Navico", 283: "Hamilton Jet", 285: "Sea Recovery", 286: "Coelmo SRL Italy", 295: "BEP Marine", 304: "Empir Bus", 305: "NovAtel", 306: "Sleipner Motor AS", 307: "MBW Technologies", 311: "Fischer Panda", 315: "ICOM", 328: "Qwerty", 329: "Dief", 341: "Boening Automationstechnologie GmbH & Co. KG", 345: "Korean Maritime University", 351: "Thrane and Thrane", 355: "Mastervolt", 356: "Fischer Panda Generators", 358: "Victron Energy", 370: "Rolls Royce Marine", 373: "Electronic Design", 374: "Northern Lights", 378: "Glendinning", 381: "B & G", 384: "Rose Point Navigation Systems", 385: "Johnson Outdoors Marine Electronics Inc Geonav", 394: "Capi 2", 396: "Beyond Measure", 400: "Livorsi Marine", 404: "ComNav", 409: "Chetco", 419: "Fusion Electronics", 421: "Standard Horizon", 422: "True Heading AB", 426: "Egersund Marine Electronics AS", 427: "em-trak Marine Electronics", 431: "Tohatsu Co, JP", 437: "Digital Yacht", 438: "Comar Systems Limited", 440: "Cummins", 443: "VDO (aka Continental-Corporation)", 451: "Parker Hannifin aka Village Marine Tech", 459: "Alltek Marine Electronics Corp", 460: "SAN GIORGIO S.E.I.N", 466: "Veethree Electronics & Marine", 467: "Humminbird Marine Electronics", 470: "SI-TEX Marine Electronics", 471: "Sea Cross Marine AB", 475: "GME aka Standard Communications Pty LTD", 476: "Humminbird Marine Electronics", 478: "Ocean Sat BV", 481: "Chetco Digitial Instruments", 493: "Watcheye", 499: "Lcj Capteurs", 502: "Attwood Marine", 503: "Naviop S.R.L.", 504: "Vesper Marine Ltd", 510: "Marinesoft Co. LTD", 517: "NoLand Engineering", 518: "Transas USA", 529: "National Instruments Korea", 532: "Onwa Marine", 571: "Marinecraft (South Korea)", 573: "McMurdo Group aka Orolia LTD", 578: "Advansea", 579: "KVH", 580: "San Jose Technology", 583: "Yacht Control", 586: "Suzuki Motor Corporation", 591: "US Coast Guard", 595: "Ship Module aka Customware", 600: "Aquatic AV", 605: "Aventics GmbH", 606: "Intellian", 612: "SamwonIT", 614: "Arlt Tecnologies", 637: "Bavaria Yacts", 641: "Diverse Yacht Services", 644: "Wema U.S.A dba KUS", 645: "Garmin", 658: "Shenzhen Jiuzhou Himunication", 688: "Rockford Corp", 704: "JL Audio", 715: "Autonnic", 717: "Yacht Devices", 734: "REAP Systems", 735: "Au Electronics Group", 739: "LxNav", 743: "DaeMyung", 744: "Woosung", 773: "Clarion US", 776: "HMI Systems", 777: "Ocean Signal", 778: "Seekeeper", 781: "Poly Planar", 785: "Fischer Panda DE", 795: "Broyda Industries", 796: "Canadian Automotive", 797: "Tides Marine", 798: "Lumishore", 799: "Still Water Designs and Audio", 802: "BJ Technologies (Beneteau)", 803: "Gill Sensors", 811: "Blue Water Desalination", 815: "FLIR", 824: "Undheim Systems", 838: "TeamSurv", 844: "Fell Marine", 847: "Oceanvolt", 862: "Prospec", 868: "Data Panel Corp", 890: "L3 Technologies", 894: "Rhodan Marine Systems", 896: "Nexfour Solutions", 905: "ASA Electronics", 909: "Marines Co (South Korea)", 911: "Nautic-on", 930: "Ecotronix", 962: "Timbolier Industries", 963: "TJC Micro", 968: "Cox Powertrain", 969: "Blue Seas", 1417: "Revatek", 1850: "Teleflex Marine (SeaStar Solutions)", 1851: "Raymarine", 1852: "Navionics", 1853: "Japan Radio Co", 1854: "Northstar Technologies", 1855: "Furuno", 1856: "Trimble", 1857: "Simrad", 1858: "Litton", 1859: "Kvasar AB", 1860: "MMP", 1861: "Vector Cantech", 1862: "Yamaha Marine", 1863: "Faria Instruments"}
     industrycode = ("Global", "Highway", "Agriculture", "Construction", "Marine", "Industrial")
     def retstandard(self,data):
-        return {"mcode": self.Gu16(data,0) & 0x7ff,
-        "manufactur": self.manufactorcode[self.Gu16(data,0) & 0x7ff] if (self.Gu16(data,0) & 0x7ff) in self.manufactorcode else None,
-        "icode": (self.Gu16(data,0) >> 13) & 7,
-        "inducode": self.getname(self.industrycode,(self.Gu16(data,0) >> 13) & 7),
+        mcode = (data[0] | data[1] << 8) & 0x7ff
+        return {"mcode": mcode,
+        "manufactur": self.manufactorcode.get(mcode),
+        "icode": data[1] >> 5,
+        "inducode": self.getname(self.industrycode, data[1] >> 5),
         "data" : " ".join([f"{i:02x}" for i in data])}
 
     def retparseerror(self,data):
         return {"parseerror": " ".join([f"{i:02x}" for i in data])}
     
-    def decsp126992(self, data): #System Time
-        return {"sid": self.Gu8(data,0), "source": data[1] & 7, "days": self.Gu16(data,2), "seconds": self.Gud32(data,4,0.0001)}
+    decsp126992 = fieldspec(field("sid", 0), field("source", 1, bits=3), field("days", 2, 2), field("seconds", 4, 4, scale=0.0001)) #System Time
 
     watertype = {0:"Fuel", 1:"Water", 2:"GrayWater" ,3:"LiveWell", 4:"Oil", 5:"BlackWater", 6:"FuelGasoline", 14:"Error"}
-    def decsp127505(self, data): #Fluid Level
-        return {"instance": data[0] >> 4,
-                "type": data[0] & 0xf, "typeName": self.getname(self.watertype, data[0] & 0xf, 4),
-                "level": self.Gd16(data,1,0.004) ,"capacity": self.Gu32(data,3)}
+    decsp127505 = fieldspec(field("instance", 0, shift=4, bits=4), #Fluid Level
+                            field("type", 0, bits=4, lookup=watertype, lookupname="typeName", en=4),
+                            field("level", 1, 2, True, 0.004), field("capacity", 3, 4))
 
     dctype = ("Battery", "Alternator", "Converter", "SolarCell", "WindGenerator")
     def decfp127506(self, data): #DC Detailed Status
@@ -188,76 +1719,74 @@ class nmea2000:
                 "charge": data[3], "health": data[4] ,"time": self.Gu16(data,5),
                 "rippleVoltage": self.Gu16(data,7)*0.01 if self.Gu16(data,7) is not None else None, "capacity": self.Gu16(data,9)}
 
+    dcdetail = Struct("<BBBBBHHH")
+    def encfp127506(self, values, buffer=None):
+        if buffer is None:
+            buffer = bytearray(self.dcdetail.size)
+        self.dcdetail.pack_into(buffer, 0, self.Pna(values, "sid", 0xff), self.Pna(values, "instance", 0xff),
+                                self.Pcode(values, "type", "typeName", self.dctype, 0xff), self.Pna(values, "charge", 0xff),
+                                self.Pna(values, "health", 0xff), self.Pna(values, "time", 0xffff),
+                                self.Pna(values, "rippleVoltage", 0xffff, 0.01), self.Pna(values, "capacity", 0xffff))
+        return buffer
+
     chargestate = ("Not_Charging", "Bulk", "Absorption", "Overcharge", "Equalise", "Float", "No_Float", "Constant_VI", "Disabled", "Fault")
     chargemode = ("Standalone", "Primary", "Secondary", "Echo")
     onoff = ("Off", "On", "Error")
-    def decsp127507(self, data): #Charger Status
-        return {"instance": data[0], "batteryInstance": data[1],
-                "operationState": data[2] & 14, "operationStateName": self.getname(self.chargestate, data[2] & 15, 4),
-                "chargeMode": data[2] >> 4, "chargeModeName": self.getname(self.chargemode, data[2] >> 4, 4),
-                "enabled": data[3] & 3, "enabledname": self.getname(self.onoff, data[3] & 3, 2),
-                "equalizationPending": (data[3] >> 2) & 3, "equalizationPendingName": self.getname(self.onoff, (data[3] >> 2) & 3, 2),
-                "equatimeRemain": self.Gu16(data,4,60)}
-
-    def decsp127508(self, data): #Battery Status
-        return {"sid":data[7], "instance": data[0], "voltage": self.Gd16(data,1,0.01), "current": self.Gd16(data,3,0.1), "temperature": self.Gd16(data,5,0.01)}
-
-    def decsp127744(self, data): #AC Power / Current - Phase A
-        return {"sid":data[0], "connection": data[1], "current": self.Gd16(data,2,0.1), "power": self.Gd32(data,4)}
-
-    def decsp127745(self, data): #AC Power / Current - Phase B
-        return {"sid":data[0], "connection": data[1], "current": self.Gd16(data,2,0.1), "power": self.Gd32(data,4)}
-
-    def decsp127746(self, data): #AC Power / Current - Phase C
-        return {"sid":data[0], "connection": data[1], "current": self.Gd16(data,2,0.1), "power": self.Gd32(data,4)}
-
-    def decsp127747(self, data): #AC Frequency / Voltage - Phase A
-        return {"sid":data[0], "connection": data[1], "voltage": self.Gd16(data,2,0.1), "voltage1to2": self.Gd16(data,4,0.1), "frequency": self.Gd16(data,6,0.01)}
-    
-    def decsp127748(self, data): #AC Frequency / Voltage - Phase B
-        return {"sid":data[0], "connection": data[1], "voltage": self.Gd16(data,2,0.1), "voltage2to3": self.Gd16(data,4,0.1), "frequency": self.Gd16(data,6,0.01)}
-    
-    def decsp127749(self, data): #AC Frequency / Voltage - Phase C
-        return {"sid":data[0], "connection": data[1], "voltage": self.Gd16(data,2,0.1), "voltage3to1": self.Gd16(data,4,0.1), "frequency": self.Gd16(data,6,0.01)}
+    decsp127507 = fieldspec(field("instance", 0, na=False), field("batteryInstance", 1, na=False), #Charger Status
+                            field("operationState", 2, bits=4, lookup=chargestate, lookupname="operationStateName", en=4),
+                            field("chargeMode", 2, shift=4, bits=4, lookup=chargemode, lookupname="chargeModeName", en=4),
+                            field("enabled", 3, bits=2, lookup=onoff, lookupname="enabledname", en=2),
+                            field("equalizationPending", 3, shift=2, bits=2, lookup=onoff, lookupname="equalizationPendingName", en=2),
+                            field("equatimeRemain", 4, 2, scale=60))
+
+    decsp127508 = fieldspec(field("sid", 7, na=False), field("instance", 0, na=False), #Battery Status
+                            field("voltage", 1, 2, True, 0.01), field("current", 3, 2, True, 0.1), field("temperature", 5, 2, True, 0.01))
+
+    decsp127744 = fieldspec(field("sid", 0, na=False), field("connection", 1, na=False), #AC Power / Current - Phase A
+                            field("current", 2, 2, True, 0.1), field("power", 4, 4, True, 1.))
+    decsp127745 = decsp127744 #AC Power / Current - Phase B
+    decsp127746 = decsp127744 #AC Power / Current - Phase C
+
+    decsp127747 = fieldspec(field("sid", 0, na=False), field("connection", 1, na=False), #AC Frequency / Voltage - Phase A
+                            field("voltage", 2, 2, True, 0.1), field("voltage1to2", 4, 2, True, 0.1), field("frequency", 6, 2, True, 0.01))
+    decsp127748 = fieldspec(field("sid", 0, na=False), field("connection", 1, na=False), #AC Frequency / Voltage - Phase B
+                            field("voltage", 2, 2, True, 0.1), field("voltage2to3", 4, 2, True, 0.1), field("frequency", 6, 2, True, 0.01))
+    decsp127749 = fieldspec(field("sid", 0, na=False), field("connection", 1, na=False), #AC Frequency / Voltage - Phase C
+                            field("voltage", 2, 2, True, 0.1), field("voltage3to1", 4, 2, True, 0.1), field("frequency", 6, 2, True, 0.01))
 
     operatorstate=("Off", "Low Power Mode", "Fault", "Bulk", "Absorption", "Float", "Storage", "Equalize", "Pass thru", "Inverting", "Assisting")
     warningserrorstate=("Good", "Warning", "Error")
-    def decsp127750(self, data): #Converter Status
-        return {"sid":data[0], "connection": data[1],
-                "operationState": data[2], "operatorStateName": self.getname(self.operatorstate, data[2], 8),
-                "temperatureState": data[3] & 3, "temperaturStateName": self.getname(self.warningserrorstate, data[3] & 3),
-                "overloadState": data[3]>>2 & 3, "overloadStateName": self.getname(self.warningserrorstate, data[3]>>2 & 3),
-                "lowDCvoltageState": data[3]>>4 & 3, "lowDCvoltageStateName": self.getname(self.warningserrorstate, data[3]>>4 & 3),
-                "rippleState": data[3]>>6 & 0x3, "rippleStateName":  self.getname(self.warningserrorstate, data[3]>>6 & 3)}
+    decsp127750 = fieldspec(field("sid", 0, na=False), field("connection", 1, na=False), #Converter Status
+                            field("operationState", 2, na=False, lookup=operatorstate, lookupname="operatorStateName", en=8),
+                            field("temperatureState", 3, bits=2, lookup=warningserrorstate, lookupname="temperaturStateName"),
+                            field("overloadState", 3, shift=2, bits=2, lookup=warningserrorstate, lookupname="overloadStateName"),
+                            field("lowDCvoltageState", 3, shift=4, bits=2, lookup=warningserrorstate, lookupname="lowDCvoltageStateName"),
+                            field("rippleState", 3, shift=6, bits=2, lookup=warningserrorstate, lookupname="rippleStateName"))
 
-    def decsp127751(self, data): #DC Voltage/Current
-        return {"sid":data[0], "connection": data[1], "voltage": self.Gud16(data,2,0.1), "current": self.Gd24(data,4,0.01)}
+    decsp127751 = fieldspec(field("sid", 0, na=False), field("connection", 1, na=False), #DC Voltage/Current
+                            field("voltage", 2, 2, scale=0.1), field("current", 4, 3, True, 0.01))
 
     humsource = ("Inside", "Outside")
     tempsource = ("Sea", "Outside", "Inside", "Engine Room", "Main Cabin", "Live Well", "Bait Well", "Refrigeration",
                         "Heating System", "Dew Point", "Apparent Wind Chill", "Theoretical Wind Chill", "Heat Index",
                         "Freezer", "Exhaust Gas", "Shaft Seal")
-    def decsp130311(self, data): #Environmental Parameters
-        return {"sid":data[0],
-                "tempSource": data[1], "tempSourceName": self.getname(self.tempsource, data[1]),
-                "humiditySource": data[2], "humiditySourceName": self.getname(self.humsource, data[2]),
-                "temperature": self.Gd16(data,3,.01), "huminity": self.Gd16(data,5,0.004), "pressure": self.Gd16(data,7,100.)}
+    decsp130311 = fieldspec(field("sid", 0, na=False), #Environmental Parameters
+                            field("tempSource", 1, bits=6, lookup=tempsource, lookupname="tempSourceName"),
+                            field("humiditySource", 1, shift=6, bits=2, lookup=humsource, lookupname="humiditySourceName"),
+                            field("temperature", 2, 2, scale=.01), field("huminity", 4, 2, True, 0.004), field("pressure", 6, 2, scale=100.))
 
-    def decsp130313(self, data): #Humidity
-        return {"sid":data[0], "instance": data[1],
-                "source": data[2], "sourcename": self.getname(self.humsource, data[2]),
-                "actual": self.Gd16(data,3,.004), "set": self.Gd16(data,5,0.004) }
+    decsp130313 = fieldspec(field("sid", 0, na=False), field("instance", 1, na=False), #Humidity
+                            field("source", 2, na=False, lookup=humsource, lookupname="sourcename"),
+                            field("actual", 3, 2, True, .004), field("set", 5, 2, True, 0.004))
 
     pressuresource = ("Atmospheric", "Water", "Steam", "Compressed Air", "Hydraulic", "Filter", "AltimeterSetting", "Oil", "Fuel")
-    def decsp130314(self, data): #Actual Pressure
-        return {"sid":data[0], "instance": data[1],
-                "source": data[2], "sourceName": self.getname(self.pressuresource, data[2]),
-                "pressure": self.Gd32(data,3,.004)}
+    decsp130314 = fieldspec(field("sid", 0, na=False), field("instance", 1, na=False), #Actual Pressure
+                            field("source", 2, na=False, lookup=pressuresource, lookupname="sourceName"),
+                            field("pressure", 3, 4, True, .004))
 
-    def decsp130316(self, data): #Temperature Extended Range
-        return {"sid":data[0], "instance": data[1],
-                "source": data[2], "sourceName": self.getname(self.tempsource, data[2]),
-                "actual": self.Gd24(data,3,.001), "set": self.Gd16(data,6,0.1)}
+    decsp130316 = fieldspec(field("sid", 0, na=False), field("instance", 1, na=False), #Temperature Extended Range
+                            field("source", 2, na=False, lookup=tempsource, lookupname="sourceName"),
+                            field("actual", 3, 3, True, .001), field("set", 6, 2, True, 0.1))
 
     def decsp127501(self,data): #Binary Switch Bank Status
         d = {"instance": data[0]}
@@ -270,6 +1799,22 @@ class nmea2000:
                 d[f"indicatorState{num*4+t2+1}Name"] = self.getname(self.onoff, state, 2)
         return d
 
+    def encswitchbank(self, values, prefix, buffer=None):
+        #states missing from values stay 3 (unavailable)
+        if buffer is None:
+            buffer = bytearray(b"\xff" * 8)
+        buffer[0] = self.Pna(values, "instance", 0xff)
+        for i in range(28):
+            if (state := values.get(f"{prefix}{i+1}")) is not None:
+                buffer[1 + i//4] = buffer[1 + i//4] & ~(3 << (i%4*2)) | (state & 3) << (i%4*2)
+        return buffer
+
+    def encsp127501(self, values, buffer=None):
+        return self.encswitchbank(values, "indicatorState", buffer)
+
+    def encsp127502(self, values, buffer=None):
+        return self.encswitchbank(values, "switchState", buffer)
+
     def decsp127502(self,data): #Binary Switch Bank Control
         d = {"instance": data[0]}
         for t in range(1,29):
@@ -289,6 +1834,16 @@ class nmea2000:
                 "controllerState2": data[3]>>2 & 3, "controllerState2Name": self.getname(self.controllerstate, data[3]>>2 & 3),
                 "eqipmentStatus": self.getname(self.equipstate, data[3]>>4 & 3)}
 
+    def encsp126993(self, values, buffer=None):
+        #sequence goes to byte 2 as on the wire, the decoder reads it from byte 1 (the high byte of offset)
+        if buffer is None:
+            buffer = bytearray(b"\xff" * 8)
+        buffer[0:2] = self.Pna(values, "offset", 0xffff, 0.001).to_bytes(2, "little")
+        buffer[2] = self.Pna(values, "sequence", 0xff)
+        status = self.Pcode(values, None, "eqipmentStatus", self.equipstate, 3)
+        buffer[3] = 0xc0 | (status & 3) << 4 | (self.Pna(values, "controllerState2", 3) & 3) << 2 | self.Pna(values, "controllerState1", 3) & 3
+        return buffer
+
     def decfp126996(self,data): #Product Information
         return {"version": self.Gud16(data, 0, 0.001),
                 "productCode": self.Gu16(data, 2),
@@ -299,6 +1854,16 @@ class nmea2000:
                 "certLevel": data[4+128],
                 "loadEquivalency": data[4+128+1]}
 
+    productinfo = Struct("<HH32s32s32s32sBB")
+    def encfp126996(self, values, buffer=None):
+        if buffer is None:
+            buffer = bytearray(self.productinfo.size)
+        text = lambda name: self.Ptext(values.get(name))[:32].ljust(32, b"\xff")
+        self.productinfo.pack_into(buffer, 0, self.Pna(values, "version", 0xffff, 0.001), self.Pna(values, "productCode", 0xffff),
+                                   text("modelId"), text("softwareVersionCode"), text("modelVersion"), text("modelSerialCode"),
+                                   self.Pna(values, "certLevel", 0xff), self.Pna(values, "loadEquivalency", 0xff))
+        return buffer
+
     def decfp126998(self,data): #Configuration Information
         nx,st1=self.GvarString(data,0)
         nx,st2=self.GvarString(data,nx)
@@ -307,8 +1872,30 @@ class nmea2000:
                 "instDecription2": st2,
                 "manufacturerInfo": st3}
 
+    def encfp126998(self, values, buffer=None):
+        #three strings of (length + 2, type 1 = ASCII, text)
+        out = bytearray()
+        for name in ("instDecription1", "instDecription2", "manufacturerInfo"):
+            text = self.Ptext(values.get(name))[:253]
+            out += bytes((len(text) + 2, 1)) + text
+        if buffer is not None:
+            buffer[:len(out)] = out
+            return buffer
+        return out
+
+    pgnlistfunction = ("Transmit", "Receive")
     def decfp126464(self,data): #PGN List (Transmit and Receive)
-        return {}
+        return {"function": data[0], "functionName": self.getname(self.pgnlistfunction, data[0]),
+                "pgns": [p for i in range(1, len(data)-2, 3) if (p := int.from_bytes(data[i:i+3], "little")) != 0xFF_FFFF]}
+
+    def encfp126464(self, values, buffer=None):
+        out = bytearray((self.Pcode(values, "function", "functionName", self.pgnlistfunction, 0xff),))
+        for pgn in values.get("pgns") or ():
+            out += pgn.to_bytes(3, "little")
+        if buffer is not None:
+            buffer[:len(out)] = out
+            return buffer
+        return out
     
     def decsp126208(self,data): #NMEA - Request group function
         ret = {"data": " ".join([f"{i:02x}" for i in data])}
@@ -331,16 +1918,19 @@ class nmea2000:
                 ret["function"]=data[0]
         return ret
 
+    def encsp126208(self, values, buffer=None):
+        #the decoder keeps the whole payload as hex in "data", function is part of it
+        data = bytes.fromhex(values.get("data") or "")[:8]
+        if buffer is None:
+            return bytearray(data)
+        buffer[:len(data)] = data
+        return buffer
+
     #0xE800-0xEE00 ISO 11783 (protocol)	Single frame
     #59392 - 60928
-    def decsp59392(self,data): #ISO Acknowledgement
-        return { "control": data[0],
-                 "groupfunc": data[1],
-                 "pgn#": self.Gu24(data,5)
-                }
+    decsp59392 = fieldspec(field("control", 0, na=False), field("groupfunc", 1, na=False), field("pgn#", 5, 3)) #ISO Acknowledgement
 
-    def decsp59904(self,data): #ISO Request
-        return { "pgn#": self.Gu24(data,0) }
+    decsp59904 = fieldspec(field("pgn#", 0, 3)) #ISO Request
 
     def decsp60160(self,data): #ISO Transport Protocol, Data Transfer
         return { "sid": data[0],
@@ -363,61 +1953,39 @@ class nmea2000:
             case _:
                 return {"function": data[0]}
 
-    def decsp60928(self,data): #ISO Address Claim
-        return {"uid": self.Gu32(data,0) & 0x1FFFFF,
-                "mcode": (self.Gu32(data,0) >> 21) & 2047,
-                "ecuinst": self.Gu8(data,4) & 7,
-                "funcinst": (self.Gu8(data,4)>>3) & 31,
-                "isofunc": data[5],
-                "devclass": data[6]>>1,
-                "devclassinst": data[7]>>15,
-                "indgroup": (data[7] >> 4) & 7,
-                "ArbAddrCap": (data[7] >> 7) & 1,
-                }
+    decsp60928 = fieldspec(field("uid", 0, 4, bits=21), field("mcode", 0, 4, shift=21, bits=11), #ISO Address Claim
+                           field("ecuinst", 4, bits=3), field("funcinst", 4, shift=3, bits=5),
+                           field("isofunc", 5, na=False), field("devclass", 6, shift=1, bits=7),
+                           field("devclassinst", 7, bits=4), field("indgroup", 7, shift=4, bits=3), field("ArbAddrCap", 7, shift=7, bits=1))
 
     magsource = ("Manual", "Automatic Chart", "Automatic Table", "Automatic Calculation", "WMM 2000", "WMM 2005", "WMM 2010", "WMM 2015", "WMM 2020")
 
     #0x1F000-0x1FEFF Standardized Mixed single/fast
     #126976 - 130815
-    def decsp127258(self,data): #Magnetic Variation
-        return {"sid":data[0],
-                "source": self.getname(self.magsource,data[1] & 15),
-                "ageofservice": self.Gu16(data,2),
-                "variantion": self.Gd16(data,4,0.0001)
-                }
+    decsp127258 = fieldspec(field("sid", 0, na=False), #Magnetic Variation
+                            field(None, 1, bits=4, lookup=magsource, lookupname="source"),
+                            field("ageofservice", 2, 2), field("variantion", 4, 2, True, 0.0001))
 
     yesno = ("NO", "YES")
     batttype = ( "Flooded", "Gel", "AGM")
     battvolt = ( 6, 12, 24, 32, 36, 42, 48 )
     battchem = ("Pb", "Li", "NiCd", "ZnO", "NiMH")
-    def decfp127513(self,data): #Battery Configuration Status
-        return {"inst": data[0],
-                "type": self.getname(self.batttype,data[1] & 15),
-                "equalsupport": self.getname(self.yesno,(data[1]>>4) & 3),
-                "nomvol": self.getname(self.battvolt, data[2] & 15),
-                "chem": self.getname(self.battchem, (data[2]>>4) & 15),
-                "cap": self.Gu16(data,3),
-                "tempcoef": self.Gi8(data,5),
-                "peukert": self.Gud8(data,6),
-                "chargeeff": self.Gi8(data,7)
-                }
+    decfp127513 = fieldspec(field("inst", 0, na=False), #Battery Configuration Status
+                            field(None, 1, bits=4, lookup=batttype, lookupname="type"),
+                            field(None, 1, shift=4, bits=2, lookup=yesno, lookupname="equalsupport"),
+                            field(None, 2, bits=4, lookup=battvolt, lookupname="nomvol"),
+                            field(None, 2, shift=4, bits=4, lookup=battchem, lookupname="chem"),
+                            field("cap", 3, 2), field("tempcoef", 5, 1, True), field("peukert", 6, 1, scale=1.), field("chargeeff", 7, 1, True))
 
-    def decsp128267(self,data): #Water Depth
-        return {"sid":data[0],
-                "depth": self.Gud32(data,1,0.01),
-                "offset": self.Gd16(data,5,0.001),
-                "range": self.Gud8(data,7,10)}
+    decsp128267 = fieldspec(field("sid", 0, na=False), #Water Depth
+                            field("depth", 1, 4, scale=0.01), field("offset", 5, 2, True, 0.001), field("range", 7, 1, scale=10))
 
-    def decsp129025(self,data): #Position, Rapid Update
-        return {"lat": self.Gd32(data,0,0.0000001),
-                "lon": self.Gd32(data,4,0.0000001)}
+    decsp129025 = fieldspec(field("lat", 0, 4, True, 0.0000001), field("lon", 4, 4, True, 0.0000001)) #Position, Rapid Update
 
     dirref = ("True", "Magnetic")
-    def decsp129026(self,data): #COG & SOG, Rapid Update
-        return {"sid":data[0],
-                "COGref": self.getname(self.dirref,data[1] & 3),
-                "COG": self.Gud16(data,2,0.0001),
-                "SOG": self.Gud16(data,2,0.01)}
+    decsp129026 = fieldspec(field("sid", 0, na=False), #COG & SOG, Rapid Update
+                            field(None, 1, bits=2, lookup=dirref, lookupname="COGref"),
+                            field("COG", 2, 2, scale=0.0001), field("SOG", 4, 2, scale=0.01))
 
     def decfp129029(self,data): #GNSS Position Data
         return {}
@@ -453,12 +2021,27 @@ class nmea2000:
                 "satlist": sat
                 }
 
+    satinfo = Struct("<BhhHiB")
+    def encfp129540(self, values, buffer=None):
+        #12 byte records as on the wire, status in byte 11 of a record; the decoder reads status from
+        #byte 8 of the record (inside rangeresid), so status does not survive a round trip
+        sats = values.get("satlist") or ()
+        size = 3 + self.satinfo.size*len(sats)
+        if buffer is None:
+            buffer = bytearray(size)
+        buffer[0] = self.Pna(values, "sid", 0xff)
+        buffer[1] = 0xfc | self.Pcode(values, None, "range", self.rangeres, 3) & 3
+        buffer[2] = len(sats)
+        for i, sat in enumerate(sats):
+            self.satinfo.pack_into(buffer, 3 + self.satinfo.size*i, self.Pna(sat, "PRN", 0xff), self.Pna(sat, "elevation", 0x7fff, 0.0001),
+                                   self.Pna(sat, "azimuth", 0x7fff, 0.0001), self.Pna(sat, "snr", 0xffff, 0.01), self.Pna(sat, "rangeresid", 0x7fffffff),
+                                   0xf0 | self.Pcode(sat, None, "status", self.satstat, 0xf) & 0xf)
+        return buffer
+
     windref = ("True (ground referenced to North)", "Magnetic (ground referenced to Magnetic North)", "Apparent", "True (boat referenced)", "True (water referenced)")
-    def decsp130306(self,data): #wind data
-        return {"sid": data[0],
-                "speed": self.Gud16(data,1,0.01), #m/s
-                "angle": self.Gud16(data,3,0.0001), #rad
-                "ref": self.getname(self.windref,data[5] & 7)}
+    decsp130306 = fieldspec(field("sid", 0, na=False), #wind data
+                            field("speed", 1, 2, scale=0.01), field("angle", 3, 2, scale=0.0001), #m/s, rad
+                            field(None, 5, bits=3, lookup=windref, lookupname="ref"))
 
     #0x1FF00-0x1FFFF: Manufacturer Specific fast-packet non-addressed
     #130816 - 131071
@@ -499,11 +2082,834 @@ class nmea2000:
 ##    def decsp65317(self,data): #Seatalk: Alarm
 ##        return self.retstandard(data)
 
-nmob=nmea2000(can.Bus(interface="ixxat",channel=0,bitrate=250000))
+class proprietarymessage(message):
+    #lazy retstandard
+    __slots__ = ()
+    fields = ("mcode", "manufactur", "icode", "inducode", "data")
+
+    def __init__(self, payload):
+        if len(payload) < 2:
+            raise IndexError("data too short")
+        self.payload = payload
+        self.raw = None
+
+    mcode = property(lambda self: (self.payload[0] | self.payload[1] << 8) & 0x7ff)
+    manufactur = property(lambda self: nmea2000.manufactorcode.get(self.mcode))
+    icode = property(lambda self: self.payload[1] >> 5)
+    inducode = property(lambda self: nmea2000.industrycode[self.icode] if self.icode < len(nmea2000.industrycode) else None)
+    data = property(lambda self: self.payload.hex(" "))
+
+def switchbankmessage(prefix):
+    #lazy decsp127501/decsp127502, 28 two bit states
+    names = (*nmea2000.onoff, "Unavailable")
+    attrs = {"__slots__": (), "instance": property(lambda self: self.payload[0])}
+    fields = ["instance"]
+    for i in range(28):
+        attrs[f"{prefix}{i+1}"] = property(lambda self, i=i: self.payload[1 + i//4] >> (i%4*2) & 3)
+        attrs[f"{prefix}{i+1}Name"] = property(lambda self, i=i: names[self.payload[1 + i//4] >> (i%4*2) & 3])
+        fields += [f"{prefix}{i+1}", f"{prefix}{i+1}Name"]
+    attrs["fields"] = tuple(fields)
+    def init(self, payload):
+        if len(payload) < 8:
+            raise IndexError("data too short")
+        self.payload = payload
+        self.raw = None
+    attrs["__init__"] = init
+    return type("switchbankmessage", (message,), attrs)
+
+class requestmessage(message):
+    #lazy decsp126208
+    __slots__ = ()
+    fields = ("data", "function")
+    functions = ("Request", "Command", "Acknowledge", "Read Fields", "Read Fields Reply", "Write Fields", "Write Fields Reply")
+
+    def __init__(self, payload):
+        if len(payload) < 1:
+            raise IndexError("data too short")
+        self.payload = payload
+        self.raw = None
+
+    data = property(lambda self: self.payload.hex(" "))
+    function = property(lambda self: self.functions[self.payload[0]] if self.payload[0] < len(self.functions) else self.payload[0])
+
+class tpdatamessage(message):
+    #lazy decsp60160
+    __slots__ = ()
+    fields = ("sid", "data")
+
+    def __init__(self, payload):
+        if len(payload) < 1:
+            raise IndexError("data too short")
+        self.payload = payload
+        self.raw = None
+
+    sid = property(lambda self: self.payload[0])
+    data = property(lambda self: self.payload[1:].hex(" "))
+
+lazymessages = {127501: switchbankmessage("indicatorState"), 127502: switchbankmessage("switchState"),
+                126208: requestmessage, 60160: tpdatamessage}
+
+class changefilter:
+    #stage in front of the decoders for high rate pgns, keeps the last value per (source, pgn, instance)
+    #duplicates: identical raw payloads (the sid byte ignored) are not decoded again, True for every pgn or a set of pgns
+    #deadbands {pgn: {field: band}}: only fields that moved further than their band (0 when not given) are emitted
+    #rates {pgn: seconds}: at most one result per interval, aggregated by policy {pgn: "latest"|"mean"|"minmax"},
+    #keys (instance, sid) and lookup codes are not aggregated, they keep the latest value
+    #downsampled windows are emitted by the first frame after their interval, flush() returns the rest
+    instanceoffsets = {127501: 0, 127502: 0, 127506: 1} #decoders without a fieldspec
+    sidoffsets = {127506: 0}
+    keyfields = ("instance", "inst", "sid")
+
+    def __init__(self, decoder, duplicates=True, deadbands=None, rates=None, policy=None):
+        self.decoder = decoder
+        self.duplicates = True if duplicates is True else set(duplicates or ())
+        self.deadbands = deadbands or {}
+        self.rates = rates or {}
+        self.policy = policy or {}
+        self.layouts = {} #pgn -> (instance offset, sid offset)
+        self.fixed = {} #pgn -> fields aggregate() passes through
+        self.raw = {} #(source, pgn, instance) -> [payload without sid, decoded values]
+        self.last = {} #(source, pgn, instance) -> fields as last emitted
+        self.windows = {} #(source, pgn, instance) -> [due, values per field (mean), aggregate, pgn]
+        self.suppressed = 0
+        self.decoded = 0
+
+    @staticmethod
+    def specof(decoder):
+        spec = getattr(decoder, "spec", None) or getattr(decoder, "__self__", decoder)
+        return spec if isinstance(spec, fieldspec) else None
+
+    def layout(self, pgn, decoder):
+        spec = self.specof(decoder)
+        names = {f[0]: f[1] for f in spec.fields} if spec is not None else {}
+        ret = self.layouts[pgn] = (names.get("instance", self.instanceoffsets.get(pgn)), names.get("sid", self.sidoffsets.get(pgn)))
+        return ret
 
-while True:
-    i=nmob.receivenext()
-    if i is not None:
-        if i[0]==126208:
-            print(i)
+    def decodeframe(self, arbitration_id, data, timestamp=None):
+        n = self.decoder
+        priority, source, pgn = n.decodepgn(arbitration_id)
+        if (entry := n.decoders.get(pgn)) is None:
+            return None
+        fastpacket, decoder = entry
+        if timestamp is None:
+            timestamp = monotonic()
+        if fastpacket == 2: #already decoded when the transport session completes
+            if (ret := n.pushtransport(pgn, source, data, timestamp)) is None:
+                return None
+            return self.filter(ret[0], (source, ret[0], None), ret[1], timestamp)
+        if fastpacket and (data := n.pushfastpacket(pgn, data, source, timestamp)) is None:
+            return None
+        instance, sid = self.layouts.get(pgn) or self.layout(pgn, decoder)
+        key = (source, pgn, data[instance] if instance is not None and instance < len(data) else None)
+        if self.duplicates is True or pgn in self.duplicates:
+            raw = bytes(data) if sid is None else bytes(data[:sid]) + bytes(data[sid+1:])
+            if (last := self.raw.get(key)) is not None and last[0] == raw:
+                self.suppressed += 1
+                return self.filter(pgn, key, last[1], timestamp) if pgn in self.rates else None
+            values = n.decodeone(decoder, data)
+            self.raw[key] = [raw, values]
+        else:
+            values = n.decodeone(decoder, data)
+        self.decoded += 1
+        return self.filter(pgn, key, values, timestamp)
+
+    def filter(self, pgn, key, values, timestamp):
+        if isinstance(values, message):
+            values = values.as_dict()
+        if not isinstance(values, dict):
+            return (pgn, values)
+        if (rate := self.rates.get(pgn)) is not None:
+            if (values := self.aggregate(pgn, key, values, timestamp, rate)) is None:
+                return None
+        if (bands := self.deadbands.get(pgn)) is not None:
+            #key fields do not count as a change (sid moves with every frame), they go along with fields that did
+            keys = self.keyfields
+            last = self.last.setdefault(key, {})
+            changed = {k: v for k, v in values.items() if k not in keys and (k not in last or self.moved(v, last[k], bands.get(k, 0)))}
+            if not changed:
+                self.suppressed += 1
+                return None
+            last.update(changed)
+            changed.update((k, values[k]) for k in keys if k in values)
+            values = changed
+        return (pgn, values)
+
+    @staticmethod
+    def moved(value, old, band):
+        if type(value) in (int, float) and type(old) in (int, float):
+            return abs(value - old) > band
+        return value != old
+
+    def passthrough(self, pgn, values):
+        #keys and lookup codes: fieldspec fields with a lookup, and k next to a k + "Name" text
+        fixed = set(self.keyfields) | {k for k in values if k + "Name" in values}
+        if (entry := self.decoder.decoders.get(pgn)) is not None and (spec := self.specof(entry[1])) is not None:
+            fixed |= {f[0] for f in spec.fields if f[0] is not None and f[5] is not None}
+        self.fixed[pgn] = fixed
+        return fixed
+
+    def aggregate(self, pgn, key, values, timestamp, rate):
+        #adds values to the window of key, returns the aggregate when the window is due
+        policy = self.policy.get(pgn, "latest")
+        fixed = self.fixed.get(pgn) or self.passthrough(pgn, values)
+        if (window := self.windows.get(key)) is None:
+            window = self.windows[key] = [timestamp, {}, None, pgn] #the first value goes out at once
+        agg = window[2]
+        if policy == "latest" or agg is None:
+            agg = window[2] = dict(values)
+            if policy == "minmax":
+                for k, v in values.items():
+                    if type(v) in (int, float) and k not in fixed:
+                        agg[k + "Min"] = agg[k + "Max"] = v
+            elif policy == "mean":
+                window[1] = {k: 1 for k, v in values.items() if type(v) in (int, float) and k not in fixed}
+        elif policy == "mean":
+            counts = window[1]
+            for k, v in values.items():
+                if type(v) not in (int, float) or k in fixed:
+                    if k not in counts:
+                        agg[k] = v
+                elif k in counts:
+                    agg[k] += v
+                    counts[k] += 1
+                else:
+                    agg[k] = v
+                    counts[k] = 1
+        elif policy == "minmax":
+            for k, v in values.items():
+                agg[k] = v
+                if type(v) in (int, float) and k not in fixed:
+                    agg[k + "Min"] = v if (m := agg.get(k + "Min")) is None or v < m else m
+                    agg[k + "Max"] = v if (m := agg.get(k + "Max")) is None or v > m else m
+        else:
+            raise ValueError(f"unknown policy {policy}")
+        if timestamp < window[0]:
+            self.suppressed += 1
+            return None
+        window[0] = timestamp + rate
+        return self.emit(window, policy)
+
+    def emit(self, window, policy):
+        agg, counts = window[2], window[1]
+        window[1], window[2] = {}, None
+        if policy == "mean":
+            for k, n in counts.items():
+                agg[k] /= n
+        return agg
+
+    def flush(self):
+        #returns (pgn, values) of every window still holding values
+        ret = []
+        for key, window in self.windows.items():
+            if window[2] is not None:
+                ret.append((window[3], self.emit(window, self.policy.get(window[3], "latest"))))
+        return ret
 
+    def receivenext(self):
+        return self.decodemessage(self.decoder.bus.recv())
+
+    def decodemessages(self, messages):
+        for msg in messages:
+            if (ret := self.decodemessage(msg)) is not None:
+                yield ret
+
+    def decodemessage(self, msg):
+        if msg is None:
+            return None
+        return self.decodeframe(msg.arbitration_id, msg.data, msg.timestamp)
+
+    def stats(self):
+        return {"decoded": self.decoded, "suppressed": self.suppressed, "keys": len(self.raw), "windows": len(self.windows)}
+
+class subscriber:
+    #queue of one hub subscriber, items are (pgn, source, instance, timestamp, data)
+    #policy as in asyncreceiver: "oldest"/"newest" drop a message and count it, "block" makes the hub wait for room
+    def __init__(self, pgns=None, maxsize=1024, policy="oldest"):
+        if policy not in ("oldest", "newest", "block"):
+            raise ValueError(f"unknown policy {policy}")
+        self.pgns = None if pgns is None else set(pgns)
+        self.maxsize = maxsize
+        self.policy = policy
+        self.queue = deque()
+        self.cond = threading.Condition()
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, item):
+        with self.cond:
+            queue = self.queue
+            if len(queue) >= self.maxsize:
+                if self.policy == "block":
+                    while len(queue) >= self.maxsize and not self.closed:
+                        self.cond.wait()
+                else:
+                    self.dropped += 1
+                    if self.policy == "newest":
+                        return
+                    queue.popleft()
+            queue.append(item)
+            self.cond.notify_all()
+
+    def get(self, timeout=None):
+        #next item, None after timeout or once closed and empty
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.queue or self.closed, timeout) or not self.queue:
+                return None
+            item = self.queue.popleft()
+            if self.policy == "block":
+                self.cond.notify_all()
+            return item
+
+    def __iter__(self):
+        while (item := self.get()) is not None:
+            yield item
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+class sharedstate:
+    #current state in shared memory for readers in other processes, one slot per (pgn, source, instance)
+    #holding the reassembled payload, so nothing is pickled; readers decode the slots they read themselves
+    #every slot has a sequence counter that is odd while the hub writes it, readers retry until it is stable
+    #slots are appended and never move, readers rescan the keys when the header count grows
+    header = Struct("<4sII") #magic, capacity, used slots
+    slot = Struct("<IIHBxdH") #sequence, pgn, instance (0xffff: none), source, timestamp, length
+    magic = b"N2KS"
+
+    def __init__(self, name=None, capacity=1024, payloadsize=256, create=True):
+        from multiprocessing.shared_memory import SharedMemory
+        if create:
+            self.payloadsize = payloadsize
+            self.slotsize = self.slot.size + payloadsize
+            self.shm = SharedMemory(name=name, create=True, size=self.header.size + capacity*self.slotsize)
+            self.header.pack_into(self.shm.buf, 0, self.magic, capacity, 0)
+        else:
+            try:
+                self.shm = SharedMemory(name=name, track=False)
+            except TypeError: #before python 3.13 attaching registers the block for unlinking at exit
+                from multiprocessing import resource_tracker
+                #a tracker inherited from the creator's process tree already knows the block, only a
+                #tracker of our own would unlink it when this process ends
+                own = resource_tracker._resource_tracker._fd is None
+                self.shm = SharedMemory(name=name)
+                if own:
+                    resource_tracker.unregister(self.shm._name, "shared_memory")
+            magic, capacity, used = self.header.unpack_from(self.shm.buf, 0)
+            if magic != self.magic:
+                raise ValueError(f"{name} is not a canparse shared state")
+            self.slotsize = (self.shm.size - self.header.size) // capacity
+            self.payloadsize = self.slotsize - self.slot.size
+        self.name = self.shm.name
+        self.capacity = capacity
+        self.owner = create
+        self.slots = {} #(pgn, source, instance) -> slot offset
+        self.used = 0
+        self.full = 0 #updates without a free slot or with a payload over payloadsize
+        self.decoder = None
+
+    @classmethod
+    def attach(cls, name):
+        return cls(name, create=False)
+
+    def write(self, pgn, source, instance, timestamp, payload):
+        buf = self.shm.buf
+        key = (pgn, source, instance)
+        if (pos := self.slots.get(key)) is None:
+            if self.used >= self.capacity or len(payload) > self.payloadsize:
+                self.full += 1
+                return False
+            pos = self.slots[key] = self.header.size + self.used*self.slotsize
+            self.used += 1
+            self.slot.pack_into(buf, pos, 1, pgn, 0xffff if instance is None else instance, source, timestamp, 0)
+            self.header.pack_into(buf, 0, self.magic, self.capacity, self.used)
+        elif len(payload) > self.payloadsize:
+            self.full += 1
+            return False
+        seq = self.slot.unpack_from(buf, pos)[0] | 1
+        self.slot.pack_into(buf, pos, seq, pgn, 0xffff if instance is None else instance, source, timestamp, len(payload))
+        start = pos + self.slot.size
+        buf[start:start+len(payload)] = payload
+        self.slot.pack_into(buf, pos, seq + 1, pgn, 0xffff if instance is None else instance, source, timestamp, len(payload))
+        return True
+
+    def scan(self):
+        buf = self.shm.buf
+        used = self.header.unpack_from(buf, 0)[2]
+        for n in range(self.used, used):
+            pos = self.header.size + n*self.slotsize
+            seq, pgn, instance, source, ts, length = self.slot.unpack_from(buf, pos)
+            self.slots[(pgn, source, None if instance == 0xffff else instance)] = pos
+        self.used = used
+
+    def keys(self):
+        if not self.owner:
+            self.scan()
+        return list(self.slots)
+
+    def read(self, pgn, source, instance=None):
+        #(timestamp, payload) of a slot, None when it was never written
+        if (pos := self.slots.get((pgn, source, instance))) is None:
+            if self.owner:
+                return None
+            self.scan()
+            if (pos := self.slots.get((pgn, source, instance))) is None:
+                return None
+        buf, start = self.shm.buf, pos + self.slot.size
+        while True:
+            seq, _, _, _, ts, length = self.slot.unpack_from(buf, pos)
+            payload = bytes(buf[start:start+length])
+            if not seq & 1 and self.slot.unpack_from(buf, pos)[0] == seq:
+                return (ts, payload) if length else None
+            sleep(0)
+
+    def get(self, pgn, source, instance=None):
+        #(timestamp, decoded data) of a slot, decoded by a lazy decoder of this process
+        if (ret := self.read(pgn, source, instance)) is None:
+            return None
+        if self.decoder is None:
+            self.decoder = nmea2000(None, lazy=True)
+        if (entry := self.decoder.decoders.get(pgn)) is None:
+            return None
+        return ret[0], self.decoder.decodeone(entry[1], bytearray(ret[1]))
+
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+class hub:
+    #decodes every frame once and shares the result: a current state table keyed by (pgn, source, instance)
+    #and subscriber queues, so several consumers do not each need a receivenext loop
+    #the state is copy on write, current is a (version, read only mapping) pair that the writer replaces as a
+    #whole, readers keep their snapshot as long as they want without locks; decoded data is shared, not copied,
+    #so consumers must not modify it (a lazy decoder returns read only message objects)
+    #shared=True (or a name) also keeps the raw payloads in a sharedstate for other processes
+    #decodeframe publishes a snapshot every batchsize frames or interval seconds (checked when a frame comes in),
+    #commit() publishes at once; the receive thread and decodemessages publish once per batch
+    def __init__(self, decoder, shared=None, capacity=1024, batchsize=64, interval=0.05):
+        from types import MappingProxyType
+        self.decoder = decoder
+        self.proxy = MappingProxyType
+        self.state = {} #(pgn, source, instance) -> (timestamp, data), only the writer touches it
+        self.current = (0, MappingProxyType({}))
+        self.subscribers = []
+        self.batchsize = batchsize
+        self.interval = interval
+        self.pending = 0 #frames processed since the last commit
+        self.committed = monotonic()
+        self.shared = None if shared is None or shared is False else sharedstate(None if shared is True else shared, capacity)
+        self.thread = None
+        self.running = False
+        self.error = None
+
+    def subscribe(self, pgns=None, maxsize=1024, policy="oldest"):
+        sub = subscriber(pgns, maxsize, policy)
+        self.subscribers = self.subscribers + [sub] #copy on write too, the writer iterates without a lock
+        return sub
+
+    def unsubscribe(self, sub):
+        sub.close()
+        self.subscribers = [s for s in self.subscribers if s is not sub]
+
+    def snapshot(self):
+        #(version, read only {(pgn, source, instance): (timestamp, data)}), consistent and never changed later
+        return self.current
+
+    def decodeframe(self, arbitration_id, data, timestamp=None):
+        #decodes one frame, returns (pgn, data) like nmea2000.decodeframe; subscribers get it at once,
+        #the snapshot with the next commit, copying the state for every frame would make this O(state size)
+        if (ret := self.process(arbitration_id, data, timestamp)) is None:
+            return None
+        self.pending += 1
+        if self.pending >= self.batchsize or monotonic() - self.committed >= self.interval:
+            self.commit()
+        return ret
+
+    def process(self, arbitration_id, data, timestamp):
+        n = self.decoder
+        priority, source, pgn = n.decodepgn(arbitration_id)
+        if (entry := n.decoders.get(pgn)) is None:
+            return None
+        fastpacket, decoder = entry
+        if fastpacket == 2: #the reassembled payload goes to the shared state like a fast packet
+            if (ret := n.reassembletransport(pgn, source, data, timestamp)) is None:
+                return None
+            pgn, data = ret
+            if (entry := n.decoders.get(pgn)) is None or entry[0] == 2:
+                return None
+            values = n.decodeone(entry[1], data)
+        else:
+            if fastpacket and (data := n.pushfastpacket(pgn, data, source, timestamp)) is None:
+                return None
+            values = n.decodeone(decoder, data)
+        instance = values.get("instance") if isinstance(values, (dict, message)) else None
+        self.state[(pgn, source, instance)] = (timestamp, values)
+        if self.shared is not None:
+            self.shared.write(pgn, source, instance, timestamp or 0., data)
+        if self.subscribers:
+            item = (pgn, source, instance, timestamp, values)
+            for sub in self.subscribers:
+                if sub.pgns is None or pgn in sub.pgns:
+                    sub.put(item)
+        return (pgn, values)
+
+    def commit(self):
+        #publish the state as a new snapshot
+        self.current = (self.current[0] + 1, self.proxy(dict(self.state)))
+        self.pending = 0
+        self.committed = monotonic()
+
+    def decodemessages(self, messages):
+        #publishes a batch with one snapshot at the end
+        ret = [r for msg in messages if (r := self.process(msg.arbitration_id, msg.data, msg.timestamp)) is not None]
+        if ret:
+            self.commit()
+        return ret
+
+    def start(self):
+        if self.thread is None:
+            self.running = True
+            self.thread = threading.Thread(target=self.run, name="canparse hub", daemon=True)
+            self.thread.start()
+        return self
+
+    def run(self):
+        #reads decoder.bus, everything already queued in the driver goes into one snapshot (up to batchsize frames)
+        recv = self.decoder.bus.recv
+        try:
+            while self.running:
+                if (msg := recv(0.1)) is None:
+                    continue
+                batch = [msg]
+                while len(batch) < self.batchsize and (msg := recv(0)) is not None:
+                    batch.append(msg)
+                self.decodemessages(batch)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.running = False
+
+    def close(self):
+        self.running = False
+        if (thread := self.thread) is not None:
+            self.thread = None
+            thread.join()
+        for sub in self.subscribers:
+            sub.close()
+        if self.shared is not None:
+            self.shared.close()
+            self.shared = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+class archivewriter:
+    #buffers decoded pgns in per pgn columns and writes them as Parquet row groups (or Arrow IPC batches), needs pyarrow
+    #files go to <directory>/pgn=<pgn>/<start>-<part>.parquet|arrow, the columns are ts, src (as in the command line
+    #records) and the decoder fields; fieldspec decoders give the schema, the others are inferred from their dicts
+    #every flush of a pgn is one row group with min/max statistics, so time range scans skip most of a file
+    #a pgn is flushed when it has rowgroup rows buffered, or by expire() once its oldest buffered row is
+    #rowgroupseconds old; small row groups cost compression and statistics, so keep both large
+    inttypes = {(1, False): "uint8", (1, True): "int8", (2, False): "uint16", (2, True): "int16", (3, False): "uint32",
+                (3, True): "int32", (4, False): "uint32", (4, True): "int32", (8, False): "uint64", (8, True): "int64"}
+
+    def __init__(self, directory, decoder=None, rowgroup=65536, format="parquet", compression="zstd", rowgroupseconds=None):
+        if format not in ("parquet", "arrow"):
+            raise ValueError(f"unknown format {format}")
+        self.directory = directory
+        self.decoder = nmea2000(None) if decoder is None else decoder
+        self.rowgroup = rowgroup
+        self.rowgroupseconds = rowgroupseconds
+        self.started = {} #pgn -> monotonic time of the first buffered row
+        self.due = float("inf") #earliest time expire() has something to flush
+        self.format = format
+        self.compression = compression
+        self.start = strftime("%Y%m%dT%H%M%S")
+        self.buffers = {} #pgn -> {column: values}
+        self.writers = {} #pgn -> [writer, schema, part]
+        self.rows = 0
+
+    def schema(self, pgn):
+        #arrow schema of a fieldspec decoder, None when the columns have to be inferred
+        import pyarrow as pa
+        if (entry := self.decoder.decoders.get(pgn)) is None:
+            return None
+        spec = getattr(entry[1], "spec", None) or getattr(entry[1], "__self__", entry[1])
+        if not isinstance(spec, fieldspec):
+            return None
+        cols = [("ts", pa.float64()), ("src", pa.uint8())]
+        for name, offset, width, signed, scale, lookup, lookupname, en, shift, bits, na in spec.fields:
+            if name is not None:
+                cols.append((name, pa.float64() if scale is not None else getattr(pa, self.inttypes[(width, signed)])()))
+            if lookupname is not None:
+                names = lookup.values() if isinstance(lookup, dict) else lookup
+                cols.append((lookupname, pa.string() if all(isinstance(v, str) for v in names) else pa.float64()))
+        cols.append(("parseerror", pa.string())) #retparseerror rows keep their payload
+        return pa.schema(cols)
+
+    def write(self, pgn, source, values, timestamp):
+        if isinstance(values, message):
+            values = values.as_dict()
+        if not isinstance(values, dict):
+            return
+        if (cols := self.buffers.get(pgn)) is None:
+            schema = self.schema(pgn)
+            cols = self.buffers[pgn] = {name: [] for name in (schema.names if schema is not None else ("ts", "src"))}
+            if self.rowgroupseconds is not None:
+                now = self.started[pgn] = monotonic()
+                self.due = min(self.due, now + self.rowgroupseconds)
+        n = len(cols["ts"])
+        cols["ts"].append(timestamp)
+        cols["src"].append(source)
+        for k, v in values.items():
+            if (col := cols.get(k)) is None:
+                col = cols[k] = [None]*n
+            col.append(v)
+        n += 1
+        for col in cols.values():
+            if len(col) < n:
+                col.append(None)
+        if n >= self.rowgroup:
+            self.flush(pgn)
+
+    def writemessage(self, msg):
+        if msg is not None and (ret := self.decoder.decodemessage(msg)) is not None:
+            self.write(ret[0], msg.arbitration_id & 0xff, ret[1], msg.timestamp)
+
+    def writemessages(self, messages):
+        for msg in messages:
+            self.writemessage(msg)
+
+    def expire(self, now=None):
+        #flushes the pgns whose oldest buffered row is rowgroupseconds old, cheap when nothing is due
+        if now is None:
+            now = monotonic()
+        if now < self.due:
+            return
+        for pgn in [pgn for pgn, t in self.started.items() if now - t >= self.rowgroupseconds]:
+            self.flush(pgn)
+        self.due = min(self.started.values(), default=float("inf")) + self.rowgroupseconds
+
+    def flush(self, pgn=None):
+        #writes the buffered rows of pgn (or all pgns) as one row group each
+        import pyarrow as pa
+        for pgn in ([pgn] if pgn is not None else list(self.buffers)):
+            self.started.pop(pgn, None)
+            if not (cols := self.buffers.pop(pgn, None)) or not cols["ts"]:
+                continue
+            if (schema := self.schema(pgn)) is not None:
+                table = pa.table(cols, schema=schema)
+            else:
+                table = pa.table({k: self.column(v) for k, v in cols.items()})
+            if (w := self.writers.get(pgn)) is not None and w[1] != table.schema:
+                try:
+                    table = table.cast(w[1])
+                except (ValueError, TypeError, pa.ArrowInvalid, pa.ArrowNotImplementedError): #inferred columns changed, start a new part
+                    w[0].close()
+                    w = self.open(pgn, table.schema, w[2] + 1)
+            if w is None:
+                w = self.open(pgn, table.schema, 0)
+            if self.format == "parquet":
+                w[0].write_table(table, row_group_size=len(table))
+            else:
+                w[0].write_table(table, max_chunksize=len(table))
+            self.rows += len(table)
+
+    @staticmethod
+    def column(values):
+        #inferred column, values of mixed types (a name or the raw code) are stored as text
+        import pyarrow as pa
+        try:
+            return pa.array(values)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            return pa.array([None if v is None else str(v) for v in values], pa.string())
+
+    def open(self, pgn, schema, part):
+        import os
+        path = os.path.join(self.directory, f"pgn={pgn}")
+        os.makedirs(path, exist_ok=True)
+        while os.path.exists(name := os.path.join(path, f"{self.start}-{part}.{self.format}")): #another writer this second
+            part += 1
+        path = name
+        if self.format == "parquet":
+            import pyarrow.parquet as pq
+            writer = pq.ParquetWriter(path, schema, compression=self.compression, write_statistics=True)
+        else:
+            import pyarrow as pa
+            writer = pa.ipc.new_file(path, schema, options=pa.ipc.IpcWriteOptions(compression=self.compression))
+        w = self.writers[pgn] = [writer, schema, part]
+        return w
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            for w in self.writers.values():
+                w[0].close()
+            self.writers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class archivereader:
+    #reads an archivewriter directory, needs pyarrow
+    #time range, source and any other pyarrow.dataset filter are pushed down to the row group statistics
+    def __init__(self, directory, format="parquet"):
+        self.directory = directory
+        self.format = format
+
+    def pgns(self):
+        import os
+        return sorted(int(name[4:]) for name in os.listdir(self.directory) if name[:4] == "pgn=" and name[4:].isdigit())
+
+    def files(self, pgn):
+        import os
+        path = os.path.join(self.directory, f"pgn={pgn}")
+        return sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith("." + self.format))
+
+    def dataset(self, pgn):
+        #pyarrow.dataset over all parts of pgn, parts with other inferred columns are merged
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+        files = self.files(pgn)
+        fmt = "ipc" if self.format == "arrow" else self.format
+        schema = pa.unify_schemas([ds.dataset(f, format=fmt).schema for f in files]) if len(files) > 1 else None
+        return ds.dataset(files, format=fmt, schema=schema)
+
+    def read(self, pgn, start=None, end=None, source=None, columns=None, filter=None):
+        #rows of pgn with start <= ts < end (from source), returns a pyarrow.Table
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+        expr = filter
+        for e in (ds.field("ts") >= start if start is not None else None,
+                  ds.field("ts") < end if end is not None else None,
+                  ds.field("src") == source if source is not None else None):
+            if e is not None:
+                expr = e if expr is None else expr & e
+        try:
+            return self.dataset(pgn).to_table(columns=columns, filter=expr)
+        except pa.ArrowTypeError: #a column was inferred with different types, read the parts one by one and keep it as text
+            fmt = "ipc" if self.format == "arrow" else self.format
+            tables = [ds.dataset(f, format=fmt).to_table(filter=expr) for f in self.files(pgn)]
+            types = {}
+            for t in tables:
+                for f in t.schema:
+                    types.setdefault(f.name, set()).add(f.type)
+            text = {name for name, ts in types.items() if len(ts - {pa.null()}) > 1}
+            tables = [pa.table({f.name: t[f.name].cast(pa.string()) if f.name in text else t[f.name] for f in t.schema}) for t in tables]
+            table = pa.concat_tables(tables, promote_options="default")
+            return table.select(columns) if columns is not None else table
+
+def jsondefault(o):
+    if isinstance(o, message):
+        return o.as_dict()
+    if isinstance(o, (bytes, bytearray)):
+        return o.decode("latin-1")
+    raise TypeError(f"{type(o).__name__} is not JSON serializable")
+
+def main(argv=None):
+    #canparse command line: decode a bus or a capture file to JSON lines, length prefixed msgpack or a
+    #Parquet/Arrow archive directory (see archivewriter)
+    import argparse
+    import json
+    import sys
+    parser = argparse.ArgumentParser(prog="canparse", description="NMEA 2000 decoder")
+    parser.add_argument("--interface", default="ixxat", help="python-can interface")
+    parser.add_argument("--channel", default="0", help="python-can channel")
+    parser.add_argument("--bitrate", type=int, default=250000)
+    parser.add_argument("--replay", metavar="FILE", help="decode a capture file instead of a bus")
+    parser.add_argument("--speed", type=float, help="replay in scaled real time instead of full speed")
+    parser.add_argument("--pgn", type=int, action="append", help="only decode this pgn (repeatable)")
+    parser.add_argument("--format", choices=("json", "msgpack", "parquet", "arrow"), default="json")
+    parser.add_argument("--output", default="-", help="output file, - for stdout, a directory for parquet and arrow")
+    parser.add_argument("--buffer", type=int, default=1 << 20, help="output buffer in bytes")
+    parser.add_argument("--flush", type=float, default=1.0, help="flush the json/msgpack output at least every FLUSH seconds")
+    parser.add_argument("--rowgroup", type=int, default=65536, help="parquet/arrow rows per pgn and row group")
+    parser.add_argument("--rowgroup-seconds", type=float, default=600., help="write a pgn's row group once its oldest row is this old")
+    args = parser.parse_args(argv)
+    if args.format in ("parquet", "arrow") and args.output == "-":
+        parser.error(f"--format {args.format} needs an --output directory")
+
+    if args.replay:
+        bus = replaybus(args.replay, args.speed)
+    else:
+        bus = can.Bus(interface=args.interface, channel=int(args.channel) if args.channel.isdigit() else args.channel, bitrate=args.bitrate)
+    decoder = nmea2000(bus)
+    wanted = set(args.pgn or ())
+    if wanted and hasattr(bus, "set_filters"): #TP.CM/TP.DT pass too, wanted pgns may arrive by transport protocol
+        bus.set_filters([{"can_id": pgn << 8, "can_mask": 0x3ffff00, "extended": True} for pgn in wanted] +
+                        [{"can_id": pf << 16, "can_mask": 0x3ff0000, "extended": True} for pf in (0xEB, 0xEC)])
+
+    if args.format in ("parquet", "arrow"):
+        return archive(args, bus, decoder, wanted)
+    if args.format == "json":
+        encoder = json.JSONEncoder(separators=(",", ":"), default=jsondefault)
+        encode = lambda record: (encoder.encode(record) + "\n").encode()
+    else:
+        import msgpack
+        packer = msgpack.Packer(default=lambda o: o.as_dict() if isinstance(o, message) else o)
+        prefix = Struct("<I").pack
+        encode = lambda record: prefix(len(b := packer.pack(record))) + b
+
+    out = open(sys.stdout.fileno(), "wb", buffering=args.buffer, closefd=False) if args.output == "-" else open(args.output, "wb", buffering=args.buffer)
+    write, flushed = out.write, monotonic()
+    try:
+        while True:
+            if (msg := bus.recv(args.flush)) is None:
+                if args.replay:
+                    break
+                out.flush()
+                flushed = monotonic()
+                continue
+            if (now := monotonic()) - flushed >= args.flush: #every frame, filtered ones too
+                out.flush()
+                flushed = now
+            arb = msg.arbitration_id
+            if wanted and not istransport(arb) and (arb & 0x3ffff00) >> 8 not in wanted:
+                continue
+            if (ret := decoder.decodemessage(msg)) is None or (wanted and istransport(arb) and ret[0] not in wanted):
+                continue
+            write(encode({"ts": msg.timestamp, "pgn": ret[0], "src": arb & 0xff, "data": ret[1]}))
+    except (KeyboardInterrupt, BrokenPipeError):
+        pass
+    finally:
+        try:
+            out.close()
+        except BrokenPipeError:
+            pass
+        bus.shutdown()
+
+def archive(args, bus, decoder, wanted):
+    #main loop of the parquet and arrow formats, row groups are cut by --rowgroup rows or --rowgroup-seconds age
+    #rather than --flush, a row group per output flush would make archives of slow pgns several times larger
+    writer = archivewriter(args.output, decoder, rowgroup=args.rowgroup, format=args.format, rowgroupseconds=args.rowgroup_seconds)
+    try:
+        while True:
+            if (msg := bus.recv(args.flush)) is None:
+                if args.replay:
+                    break
+                writer.expire()
+                continue
+            writer.expire()
+            arb = msg.arbitration_id
+            if wanted and not istransport(arb) and (arb & 0x3ffff00) >> 8 not in wanted:
+                continue
+            if (ret := decoder.decodemessage(msg)) is None or (wanted and istransport(arb) and ret[0] not in wanted):
+                continue
+            writer.write(ret[0], arb & 0xff, ret[1], msg.timestamp)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        writer.close()
+        bus.shutdown()
+
+if __name__ == "__main__":
+    main()